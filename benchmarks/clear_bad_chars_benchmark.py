@@ -0,0 +1,34 @@
+"""
+Compare the regex based clear_bad_chars with the bytes level clear_bad_chars_utf8 on Devanagari-heavy utf-8 text.
+
+Usage: python benchmarks/clear_bad_chars_benchmark.py [size_in_mb]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from curation_utils import file_helper
+
+LINES = [
+  "+++\r\ntitle = \"चिद्गगनचन्द्रिका\"\r\n+++\r\n",
+  "\t\tकर्रोपपदाग्निहोत्रशास्त्रिणा धनदानन्दनाथदीक्षानामशालिना,\r\n",
+  "\t\tविरचितया `दिव्यचकोरिकया' समलंकृता ।।\r\n",
+  "\t\t\tप्रथमविमर्शः ।।​ \r\n",
+]
+
+
+def main(size_mb=10):
+  block = "".join(LINES).encode("utf-8")
+  data = block * (size_mb * 1024 * 1024 // len(block))
+  regex_path = lambda: file_helper.clear_bad_chars(file_helper.normalize_newlines(data.decode("utf-8"))).encode("utf-8")
+  bytes_path = lambda: file_helper.clear_bad_chars_utf8(data)
+  assert regex_path() == bytes_path()
+  for (name, fn) in [("regex", regex_path), ("bytes", bytes_path)]:
+    duration = min(timeit.repeat(fn, number=1, repeat=5))
+    print(f"{name:6} {duration:8.4f} s {len(data) / duration / 1048576:10.1f} MB/s")
+
+
+if __name__ == '__main__':
+  main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,69 @@
+"""
+Compare the kernel-side file_helper.concatenate_files with the old shutil.copyfileobj based implementation, and with concatenate_files_batch.
+
+Usage: python benchmarks/concatenate_files_benchmark.py [large_file_size_in_mb]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from curation_utils import file_helper
+
+
+def legacy_concatenate_files(input_path_list, output_path, add_newline_inbetween=False):
+  os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+  with open(output_path, 'wb') as outfile:
+    for f in input_path_list:
+      with open(f, 'rb') as fd:
+        shutil.copyfileobj(fd, outfile)
+      if add_newline_inbetween:
+        outfile.write("\n".encode())
+
+
+def write_files(dir_path, count, size):
+  os.makedirs(dir_path)
+  block = ("कर्रोपपदाग्निहोत्रशास्त्रिणा धनदानन्दनाथदीक्षानामशालिना\n" * 1000).encode("utf-8")
+  paths = []
+  for i in range(count):
+    paths.append(os.path.join(dir_path, "%05d.md" % i))
+    with open(paths[-1], "wb") as f:
+      for _ in range(size // len(block)):
+        f.write(block)
+      f.write(block[:size % len(block)])
+  return paths
+
+
+def timed(fn, *args, **kwargs):
+  start = time.perf_counter()
+  fn(*args, **kwargs)
+  return time.perf_counter() - start
+
+
+def main(large_file_size_mb=200):
+  with tempfile.TemporaryDirectory() as dir_path:
+    cases = {
+      "10k x 2 KB": write_files(os.path.join(dir_path, "small"), count=10000, size=2048),
+      "3 x %d MB" % large_file_size_mb: write_files(os.path.join(dir_path, "large"), count=3, size=large_file_size_mb * 1024 * 1024),
+    }
+    for (name, paths) in cases.items():
+      for (implementation, fn) in [("legacy", legacy_concatenate_files), ("kernel", file_helper.concatenate_files)]:
+        duration = timed(fn, paths, os.path.join(dir_path, "out", implementation + ".md"), add_newline_inbetween=True)
+        print(f"{name:14} {implementation:8} {duration:8.3f} s")
+      os.remove(os.path.join(dir_path, "out", "legacy.md"))
+      os.remove(os.path.join(dir_path, "out", "kernel.md"))
+
+    # 100 books of 100 chapters each.
+    chapters = cases["10k x 2 KB"]
+    books = {os.path.join(dir_path, "books", "%03d.md" % i): chapters[i * 100:(i + 1) * 100] for i in range(100)}
+    duration = timed(lambda: [legacy_concatenate_files(inputs, output, add_newline_inbetween=True) for (output, inputs) in books.items()])
+    print(f"{'100 books':14} {'legacy':8} {duration:8.3f} s")
+    duration = timed(file_helper.concatenate_files_batch, books, add_newline_inbetween=True)
+    print(f"{'100 books':14} {'batch':8} {duration:8.3f} s")
+
+
+if __name__ == '__main__':
+  main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,91 @@
+"""
+Compare the streaming file_helper.detect_encoding with the old readlines() based implementation.
+
+Each measurement runs in a freshly spawned process, so that the reported peak RSS is not polluted by earlier runs.
+
+Usage: python benchmarks/detect_encoding_benchmark.py [size_in_mb]
+"""
+import codecs
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from chardet import UniversalDetector
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEVANAGARI_LINE = "कर्रोपपदाग्निहोत्रशास्त्रिणा धनदानन्दनाथदीक्षानामशालिना विरचितया समलंकृता ।।\n"
+LATIN_LINE = "Prathama vimarsha – “Café” naïve façade, déjà vu – ½ × ¼ ± § ¶\n"
+
+
+def legacy_detect_encoding(file_path):
+  detector = UniversalDetector()
+  detector.reset()
+  with open(file_path, 'rb') as file:
+    for line in file.readlines():
+      detector.feed(line)
+      if detector.done: break
+  detector.close()
+  return detector.result['encoding']
+
+
+def _write_repeated(file_path, block, size, prefix=b""):
+  # Written block by block, so that the parent process stays small: ru_maxrss survives the exec of spawned children.
+  with open(file_path, "wb") as f:
+    f.write(prefix)
+    for _ in range(size // len(block)):
+      f.write(block)
+
+
+def write_inputs(dir_path, size_mb):
+  size = size_mb * 1024 * 1024
+  paths = {}
+  paths["utf-8"] = os.path.join(dir_path, "utf8.txt")
+  _write_repeated(paths["utf-8"], (DEVANAGARI_LINE * 1000).encode("utf-8"), size)
+  paths["utf-16"] = os.path.join(dir_path, "utf16.txt")
+  _write_repeated(paths["utf-16"], (DEVANAGARI_LINE * 1000).encode("utf-16-le"), size, prefix=codecs.BOM_UTF16_LE)
+  paths["windows-1252"] = os.path.join(dir_path, "cp1252.txt")
+  _write_repeated(paths["windows-1252"], (LATIN_LINE * 1000).encode("cp1252"), size)
+  # Python has no ISCII codec; mimic it with ISCII's 0xA1-0xFA Devanagari range.
+  paths["iscii"] = os.path.join(dir_path, "iscii.txt")
+  rng = random.Random(0)
+  line = bytes(rng.randrange(0xA1, 0xFB) if i % 7 else 0x20 for i in range(79)) + b"\n"
+  _write_repeated(paths["iscii"], line * 1000, size)
+  return paths
+
+
+def _measure(implementation, file_path, queue):
+  from curation_utils import file_helper
+  fn = legacy_detect_encoding if implementation == "legacy" else file_helper.detect_encoding
+  start = time.perf_counter()
+  encoding = fn(file_path)
+  duration = time.perf_counter() - start
+  queue.put((encoding, duration, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def measure(implementation, file_path):
+  context = multiprocessing.get_context("spawn")
+  queue = context.Queue()
+  process = context.Process(target=_measure, args=(implementation, file_path, queue))
+  process.start()
+  result = queue.get()
+  process.join()
+  return result
+
+
+def main(size_mb=200):
+  with tempfile.TemporaryDirectory() as dir_path:
+    paths = write_inputs(dir_path=dir_path, size_mb=size_mb)
+    print(f"{'input':14} {'implementation':15} {'encoding':14} {'seconds':>8} {'peak RSS MB':>12}")
+    for name, file_path in paths.items():
+      for implementation in ["legacy", "streaming"]:
+        (encoding, duration, peak_rss) = measure(implementation=implementation, file_path=file_path)
+        print(f"{name:14} {implementation:15} {str(encoding):14} {duration:8.2f} {peak_rss:12.1f}")
+
+
+if __name__ == '__main__':
+  main(*[int(x) for x in sys.argv[1:]])
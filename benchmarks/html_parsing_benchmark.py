@@ -0,0 +1,48 @@
+"""
+Compare BeautifulSoup parsers, full versus partial (parse_only) parsing, and the text and links extractor.
+
+Usage: python benchmarks/html_parsing_benchmark.py [saved_page.html ...]
+Without arguments, a synthetic page of about 1 MB is used.
+"""
+import importlib.util
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from curation_utils import scraping
+
+ENTRY = """<div class="entry"><h2><a href="/post/%d">पोस्ट %d</a></h2>
+<p>नमस्ते <b>world</b> &amp; some <i>text</i>, with <a href="https://example.com/%d">a link</a>.</p>
+<ul><li>one</li><li>two</li><li>three</li></ul></div>
+"""
+
+
+def _synthetic_page(entry_count=4000):
+  entries = "".join(ENTRY % (i, i, i) for i in range(entry_count))
+  return "<html><head><title>Sample</title></head><body><div id='nav'><a href='/'>Home</a></div><div id='content'>%s</div></body></html>" % entries
+
+
+def main(*page_paths):
+  if page_paths:
+    pages = []
+    for page_path in page_paths:
+      with open(page_path, 'r', encoding="utf-8", errors="replace") as page_file:
+        pages.append(page_file.read())
+  else:
+    pages = [_synthetic_page()]
+  size = sum(len(page.encode("utf-8")) for page in pages)
+  parsers = ["html.parser"] + (["lxml"] if importlib.util.find_spec("lxml") is not None else [])
+  cases = []
+  for parser in parsers:
+    cases.append((f"{parser} full", lambda parser=parser: [scraping.make_soup(page, features=parser) for page in pages]))
+    cases.append((f"{parser} #nav", lambda parser=parser: [scraping.make_soup(page, features=parser, parse_only="#nav") for page in pages]))
+  cases.append(("text+links", lambda: [scraping.extract_text_and_links(page) for page in pages]))
+  for (name, fn) in cases:
+    duration = min(timeit.repeat(fn, number=1, repeat=3))
+    print(f"{name:18} {duration:8.4f} s {size / duration / 1048576:8.2f} MB/s")
+
+
+if __name__ == '__main__':
+  main(*sys.argv[1:])
@@ -0,0 +1,113 @@
+"""
+Compare MultiFileReader with its old implementation (linear scan of the file ranges, bytes concatenation), for sequential and random reads; and its mmap mode for random reads.
+
+Usage: python benchmarks/multi_file_reader_benchmark.py [file_count]
+"""
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from builtins import open as fopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from curation_utils.file_helper.multi_file_reader import MultiFileReader
+
+
+class LegacyMultiFileReader(io.BufferedIOBase):
+
+  def __init__(self, filenames):
+    files = []
+    ranges = []
+    offset = 0
+    for name in filenames:
+      size = os.stat(name).st_size
+      ranges.append(range(offset, offset+size))
+      files.append(fopen(name, 'rb'))
+      offset += size
+    self.size = offset
+    self._ranges = ranges
+    self._files = files
+    self._fcount = len(self._files)
+    self._offset = 0
+
+  def close_files(self):
+    for f in self._files:
+      f.close()
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    self._offset = offset
+    return self._offset
+
+  def read(self, n=-1):
+    file_index = -1
+    actual_offset = 0
+    for i, r in enumerate(self._ranges):
+      if self._offset in r:
+        file_index = i
+        actual_offset = self._offset - r.start
+        break
+    result = b''
+    if (n == -1 or n is None):
+      to_read = self.size
+    else:
+      to_read = n
+    while -1 < file_index < self._fcount:
+      f = self._files[file_index]
+      f.seek(actual_offset)
+      read = f.read(to_read)
+      read_count = len(read)
+      self._offset += read_count
+      result += read
+      to_read -= read_count
+      if to_read > 0:
+        file_index += 1
+        actual_offset = 0
+      else:
+        break
+    return result
+
+
+def sequential(reader, block_size):
+  reader.seek(0)
+  while reader.read(block_size):
+    pass
+
+
+def random_reads(reader, offsets, n):
+  for offset in offsets:
+    reader.seek(offset)
+    reader.read(n)
+
+
+def timed(fn, *args):
+  start = time.perf_counter()
+  fn(*args)
+  return time.perf_counter() - start
+
+
+def main(file_count=5000):
+  rng = random.Random(0)
+  with tempfile.TemporaryDirectory() as dir_path:
+    paths = []
+    for i in range(file_count):
+      paths.append(os.path.join(dir_path, "%05d.txt" % i))
+      with open(paths[-1], "wb") as f:
+        f.write(os.urandom(rng.randrange(512, 4096)))
+    readers = {"legacy": LegacyMultiFileReader(paths), "new": MultiFileReader(paths)}
+    offsets = [rng.randrange(0, readers["new"].size) for _ in range(20000)]
+    for (name, reader) in readers.items():
+      print(f"{name:8} sequential read(4096): {timed(sequential, reader, 4096):8.3f} s")
+      print(f"{name:8} sequential read(1 MiB): {timed(sequential, reader, 1048576):8.3f} s")
+      print(f"{name:8} 20k random read(256):   {timed(random_reads, reader, offsets, 256):8.3f} s")
+    readers["legacy"].close_files()
+    readers["new"].close()
+    with MultiFileReader(paths, use_mmap=True, max_mappings=None) as reader:
+      print(f"{'mmap':8} 20k random read(256):   {timed(random_reads, reader, offsets, 256):8.3f} s")
+      print(f"{'mmap':8} 20k getbuffer(256):     {timed(lambda: [reader.getbuffer(offset, 256) for offset in offsets]):8.3f} s")
+
+
+if __name__ == '__main__':
+  main(*[int(x) for x in sys.argv[1:]])
@@ -1,9 +1,20 @@
+import fnmatch
+import functools
+import json
 import logging, regex
 import os
 import pprint
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 
+import backoff
 import internetarchive
+import requests
+
+from curation_utils.file_helper.download_manager import _is_permanent_error
+from curation_utils.file_helper.manifest import FileManifest, get_md5
 
 for handler in logging.root.handlers[:]:
   logging.root.removeHandler(handler)
@@ -12,30 +23,102 @@ logging.basicConfig(
   format="%(levelname)s:%(asctime)s:%(module)s:%(lineno)d %(message)s"
 )
 
+# Name of the file, kept in the local directory, recording md5s of local files and of what was last uploaded from them.
+SYNC_MANIFEST_NAME = ".archive_sync_manifest.jsonl"
+# Attempts at uploading each file.
+UPLOAD_MAX_TRIES = 5
+DEFAULT_FILE_PATTERNS = ["*.mp3", "*.txt", "*.pdf"]
+
+
+def _upload(archive_item, remote_name, file_path):
+  # checksum=True here would have archive.org compare against its copies, whose md5s (of mp3s, say) vary with metadata changes. plan_sync does the comparison instead.
+  (response,) = archive_item.archive_item.upload({remote_name: file_path}, verbose=False, checksum=False, verify=False,
+                                                 metadata=archive_item.metadata, queue_derive=False)
+  response.raise_for_status()
+  return response
+
+
+def _retry_uploads(wait_gen=backoff.expo, **wait_gen_kwargs):
+  """
+  A decorator retrying uploads (up to UPLOAD_MAX_TRIES times) on transient errors. Client errors (bad metadata or keys, say) are not retried.
+
+  internetarchive re-raises socket resets during uploads as ConnectionResetError, rather than as a RequestException.
+  """
+  return backoff.on_exception(wait_gen, (requests.exceptions.RequestException, ConnectionResetError), max_tries=UPLOAD_MAX_TRIES,
+                              giveup=_is_permanent_error, **wait_gen_kwargs)
+
+
+_upload_backoffed = _retry_uploads(max_value=300)(_upload)
+
 
 class ArchiveItem(object):
   """
   Represents an archive.org item.
   """
 
-  def __init__(self, archive_id, metadata=None, config_file_path="/home/vvasuki/.config/internetarchive/ia.ini", repo_base=None):
+  def __init__(self, archive_id, metadata=None, config_file_path="/home/vvasuki/.config/internetarchive/ia.ini", repo_base=None, metadata_cache_dir=None, metadata_ttl=3600):
     """
-    
+    Nothing is fetched until needed: the item's metadata is loaded on first access of archive_item (or of its files).
+
     :param archive_id: 
     :param config_file_path:
     :param repo_base: In archive item, place each file in a folder mirroring its local location.
+    :param metadata_cache_dir: If given, item metadata is cached in this directory, and reused for metadata_ttl seconds.
     """
     self.repo_base = repo_base
     self.archive_id = archive_id
-    self.archive_session = internetarchive.get_session(config_file=config_file_path)
-    self.archive_item = internetarchive.get_item(archive_id, config_file=config_file_path)
+    self.config_file_path = config_file_path
     self.metadata = metadata
-    logging.info(self.archive_item.identifier)
+    self.metadata_cache_dir = metadata_cache_dir
+    self.metadata_ttl = metadata_ttl
+    logging.info(self.archive_id)
+
+  @property
+  def archive_session(self):
+    return get_session(config_file_path=self.config_file_path)
 
-    self.original_item_files = list(filter(
+  def _get_metadata_cache_path(self):
+    return os.path.join(self.metadata_cache_dir, "%s.json" % self.archive_id)
+
+  @functools.cached_property
+  def archive_item(self):
+    if self.metadata_cache_dir is not None:
+      cache_path = self._get_metadata_cache_path()
+      if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < self.metadata_ttl:
+        with open(cache_path, 'r', encoding="utf-8") as cache_file:
+          return internetarchive.Item(self.archive_session, self.archive_id, item_metadata=json.load(cache_file))
+    archive_item = internetarchive.get_item(self.archive_id, archive_session=self.archive_session)
+    if self.metadata_cache_dir is not None:
+      os.makedirs(self.metadata_cache_dir, exist_ok=True)
+      with open(self._get_metadata_cache_path(), 'w', encoding="utf-8") as cache_file:
+        json.dump(archive_item.item_metadata, cache_file)
+    return archive_item
+
+  @functools.cached_property
+  def item_files_dict(self):
+    """
+    The item's files (their metadata), by name.
+    """
+    return {item_file["name"]: item_file for item_file in self.archive_item.files}
+
+  @functools.cached_property
+  def original_item_files(self):
+    return list(filter(
       lambda x: x["source"] == "original" and not x["name"].startswith(self.archive_item.identifier) and not x[
         "name"].startswith("_"), self.archive_item.files))
-    self.original_item_file_names = sorted(map(lambda x: x["name"], self.original_item_files))
+
+  @functools.cached_property
+  def original_item_file_names(self):
+    return sorted(map(lambda x: x["name"], self.original_item_files))
+
+  def forget_item(self):
+    """
+    Drop the loaded (and cached) item metadata - say, after the item was modified - so that it is fetched afresh when next needed.
+    """
+    for name in ["archive_item", "item_files_dict", "original_item_files", "original_item_file_names"]:
+      self.__dict__.pop(name, None)
+    if self.metadata_cache_dir is not None and os.path.exists(self._get_metadata_cache_path()):
+      os.remove(self._get_metadata_cache_path())
 
   def __str__(self, *args, **kwargs):
     return self.archive_id
@@ -46,6 +129,7 @@ class ArchiveItem(object):
       logging.error("Archive item ought to exist for this to work, but it does not.")
     else:
       self.archive_item.modify_metadata(metadata=self.metadata)
+      self.forget_item()
 
   def get_remote_name(self, file_path):
     """
@@ -58,15 +142,70 @@ class ArchiveItem(object):
     return regex.sub(self.repo_base + "/*", "", file_path) if self.repo_base else basename
 
 
-  def delete_matching(self, pattern, dry_run=False):
-    files_to_delete = []
-    for file_id, details in self.item_files_dict.items():
-      if regex.fullmatch(pattern, file_id) is not None:
-        files_to_delete.append(file_id)
-    
-    logging.info(f"Deleting {files_to_delete}")
-    if not dry_run:
-      internetarchive.delete(self.archive_item.identifier, files=files_to_delete, cascade_delete=True, access_key=self.archive_session.access_key, secret_key=self.archive_session.secret_key)
+  def find_files(self, patterns=(), glob_patterns=()):
+    """
+    Find item files whose names fully match any of the given regex or glob patterns - in a single pass over the files, with string and glob patterns combined into one compiled pattern.
+
+    :param patterns: Regular expressions (strings or compiled).
+    :param glob_patterns: Patterns like "*.mp3" or "mp3/*_old.mp3".
+    :return: Matching file names, in item order.
+    """
+    if isinstance(patterns, str) or hasattr(patterns, "pattern"):
+      patterns = [patterns]
+    if isinstance(glob_patterns, str):
+      glob_patterns = [glob_patterns]
+    # Compiled patterns are matched as they are, so as to keep their flags; the rest are combined into one pattern.
+    matchers = [pattern for pattern in patterns if not isinstance(pattern, str)]
+    alternatives = [pattern for pattern in patterns if isinstance(pattern, str)] + [fnmatch.translate(glob_pattern) for glob_pattern in glob_patterns]
+    if len(alternatives) > 0:
+      matchers.append(regex.compile("|".join("(?:%s)" % alternative for alternative in alternatives)))
+    if len(matchers) == 0:
+      return []
+    return [name for name in self.item_files_dict if any(matcher.fullmatch(name) is not None for matcher in matchers)]
+
+  def delete_files(self, file_names, dry_run=False, batch_size=50, workers=4):
+    """
+    Delete files, in batches of batch_size handled by workers concurrent threads.
+
+    :return: A dict from file name to None (deleted) or the error.
+    """
+    file_names = list(file_names)
+    if len(file_names) == 0:
+      return {}
+    logging.info("************************* Deleting from %s the below files: \n%s", self, pprint.pformat(file_names))
+    if dry_run:
+      logging.warning("Not doing anything - in dry_run mode")
+      return {}
+
+    def delete_batch(batch):
+      results = {}
+      for file_name in batch:
+        try:
+          response = self.archive_item.get_file(file_name).delete(cascade_delete=True, access_key=self.archive_session.access_key, secret_key=self.archive_session.secret_key, retries=2)
+          response.raise_for_status()
+          results[file_name] = None
+        except Exception as e:
+          logging.error("Could not delete %s from %s: %s", file_name, self, e)
+          results[file_name] = repr(e)
+      return results
+
+    results = {}
+    batches = [file_names[i:i + batch_size] for i in range(0, len(file_names), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      for batch_results in executor.map(delete_batch, batches):
+        results.update(batch_results)
+    logging.info("Deleted %d files from %s; %d failures", sum(1 for error in results.values() if error is None), self, sum(1 for error in results.values() if error is not None))
+    self.forget_item()
+    return results
+
+  def delete_matching(self, pattern=None, dry_run=False, glob_pattern=None):
+    """
+    Delete files whose names fully match pattern (a regex) or glob_pattern.
+
+    :return: As delete_files.
+    """
+    files_to_delete = self.find_files(patterns=[pattern] if pattern is not None else [], glob_patterns=[glob_pattern] if glob_pattern is not None else [])
+    return self.delete_files(files_to_delete, dry_run=dry_run)
 
   def delete_unaccounted_for_files(self, all_files_or_dir, dry_run=False):
     """
@@ -74,85 +213,269 @@ class ArchiveItem(object):
 
     May not satisfactorily delete files under directories.
     :param all_files_or_dir: This has to include exactly _every_ file that is expected to be present in the archive item.
+    :return: As delete_files.
     """
     if all_files_or_dir is None:
       all_files_or_dir = self.repo_base
     if isinstance(all_files_or_dir, str):
-      local_basenames = list(map(os.path.basename, os.listdir(all_files_or_dir)))
+      local_basenames = set(map(os.path.basename, os.listdir(all_files_or_dir)))
+    else:
+      local_basenames = set(map(os.path.basename, all_files_or_dir))
+    false_original_item_file_names = [name for name in self.original_item_file_names if name not in local_basenames]
+    return self.delete_files(false_original_item_file_names, dry_run=dry_run)
+
+  def _get_sync_manifest(self, file_paths):
+    manifest_dir = self.repo_base if self.repo_base else os.path.dirname(os.path.abspath(file_paths[0]))
+    return FileManifest(os.path.join(manifest_dir, SYNC_MANIFEST_NAME), root_dir=manifest_dir)
+
+  def _matches_remote_file(self, file_path, remote_file, manifest=None):
+    if "size" in remote_file and int(remote_file["size"]) != os.path.getsize(file_path):
+      return False
+    if "md5" not in remote_file:
+      return True
+    local_md5 = manifest.get_md5(file_path) if manifest is not None else get_md5(file_path)
+    return local_md5 == remote_file["md5"]
+
+  def _is_older_than_remote_file(self, file_path, remote_file, manifest):
+    """Whether file_path, with no upload recorded in manifest, was last modified before the item's copy was."""
+    if "uploaded_md5" in manifest.get_entry(file_path) or "mtime" not in remote_file:
+      return False
+    return os.path.getmtime(file_path) < float(remote_file["mtime"])
+
+  def plan_sync(self, file_paths, checksum=True, manifest=None):
+    """
+    Determine which local files need uploading: those absent in the item and, with checksum, those whose size or md5 differ from the item's copy.
+
+    A file is not considered changed if its md5 is what was last uploaded from it - archive.org rewrites some files (say, tags of mp3s), so that the item's md5 can differ from the uploaded file's.
+    Lacking a record of the last upload (as on the first sync of an existing item), a file older than the item's copy (by its mtime) is taken to be what was uploaded.
+
+    :param manifest: A FileManifest caching local md5s across runs (see SYNC_MANIFEST_NAME).
+    :return: A dict from remote name to local file path.
+    """
+    remote_files = {item_file["name"]: item_file for item_file in self.original_item_files}
+    remote_name_to_file_path = {}
+    unchanged_count = 0
+    for file_path in file_paths:
+      if os.path.basename(file_path) == SYNC_MANIFEST_NAME:
+        continue
+      remote_name = self.get_remote_name(file_path)
+      remote_file = remote_files.get(remote_name)
+      if remote_file is None:
+        remote_name_to_file_path[remote_name] = file_path
+        continue
+      if not checksum:
+        unchanged_count += 1
+        continue
+      if self._matches_remote_file(file_path, remote_file=remote_file, manifest=manifest):
+        unchanged_count += 1
+      elif manifest is not None and manifest.get_md5(file_path) == manifest.get_entry(file_path).get("uploaded_md5"):
+        unchanged_count += 1
+      elif manifest is not None and self._is_older_than_remote_file(file_path, remote_file=remote_file, manifest=manifest):
+        # Presumably uploaded before there was a manifest, and since rewritten by archive.org.
+        manifest.record(file_path, md5=manifest.get_md5(file_path), uploaded_md5=manifest.get_md5(file_path))
+        unchanged_count += 1
+      else:
+        remote_name_to_file_path[remote_name] = file_path
+    logging.info(f"{len(remote_name_to_file_path)} new or changed files; {unchanged_count} unchanged.")
+    return remote_name_to_file_path
+
+  def plan_uploads(self, file_paths, overwrite_all=False, checksum=True):
+    """
+    :return: (A dict from remote name to local file path of files to upload, the sync FileManifest or None)
+    """
+    if len(file_paths) == 0:
+      return ({}, None)
+    manifest = self._get_sync_manifest(file_paths) if checksum else None
+    logging.info(f"Got {len(self.original_item_file_names)} remote files and {len(file_paths)} local files.")
+    if overwrite_all:
+      uploads = {self.get_remote_name(file_path): file_path for file_path in file_paths if os.path.basename(file_path) != SYNC_MANIFEST_NAME}
     else:
-      local_basenames = list(map(os.path.basename, all_files_or_dir))
-    # Deletion
-    false_original_item_file_names = list(
-      filter(lambda x: x not in local_basenames, self.original_item_file_names))
-    if len(false_original_item_file_names) > 0:
-      logging.info("************************* Deleting %s the below unaccounted for files: \n%s", self, pprint.pformat(
-        false_original_item_file_names))
-    if len(false_original_item_file_names) > 0 and not dry_run:
-      internetarchive.delete(self.archive_item.identifier, files=false_original_item_file_names, cascade_delete=True,
-                             access_key=self.archive_session.access_key, secret_key=self.archive_session.secret_key)
-
-  def update_with_files(self, file_paths, overwrite_all=False, dry_run=False):
+      uploads = self.plan_sync(file_paths=file_paths, checksum=checksum, manifest=manifest)
+    return (uploads, manifest)
+
+  def upload_file(self, remote_name, file_path):
+    """
+    Upload a single file, retrying (up to UPLOAD_MAX_TRIES times) with backoff.
+
+    :return: The response. Raises once retries are exhausted.
+    """
+    return _upload_backoffed(self, remote_name, file_path)
+
+  def update_with_files(self, file_paths, overwrite_all=False, dry_run=False, checksum=True, workers=4):
     """
     Upload some files.
 
     :param file_paths: List of Strings.
     :param overwrite_all: Boolean.
     :param dry_run: Boolean.
+    :param checksum: Also upload files whose size or md5 differ from the item's copy - not just new files. Local md5s are cached in a SYNC_MANIFEST_NAME file.
+    :param workers: Number of files uploaded concurrently.
+    :return: A dict with lists of the uploaded remote names and of (remote name, error) failures.
     """
+    result = {"uploaded": [], "failed": []}
     if len(file_paths) == 0:
       logging.debug("file_paths is empty.")
       import traceback
       # for line in traceback.format_stack():
       #     logging.debug(line.strip())
-      return
+      return result
     logging.info("************************* Now uploading to %s from %s", self, os.path.dirname(file_paths[0]))
-    remote_names = list(map(lambda file_path: self.get_remote_name(file_path), file_paths))
-    remote_name_to_file_path = dict(
-      zip(remote_names, file_paths))
-    logging.info(f"Got {len(self.original_item_file_names)} remote files and {len(remote_names)} local files.")
-    remote_name_to_file_path_filtered = remote_name_to_file_path
-    if not overwrite_all:
-      remote_name_to_file_path_filtered = dict(
-        filter(lambda item: item[0] not in self.original_item_file_names, remote_name_to_file_path.items()))
+    (remote_name_to_file_path_filtered, manifest) = self.plan_uploads(file_paths=file_paths, overwrite_all=overwrite_all, checksum=checksum)
     logging.info(f"Uploading {len(remote_name_to_file_path_filtered)} files")
     # logging.debug(pprint.pformat(remote_name_to_file_path_filtered.items()))
     if dry_run:
       logging.warning("Not doing anything - in dry_run mode")
     else:
       if len(remote_name_to_file_path_filtered) > 0:
-        # checksum=True seems to not avoid frequent reuploads. Archive item mp3 checksum end up varying because of metadata changes? 
-        responses = self.archive_item.upload(remote_name_to_file_path_filtered, verbose=False, checksum=False,
-                                             verify=False, metadata=self.metadata, retries=6, queue_derive=False)
-        logging.info(pprint.pformat(dict(zip(remote_name_to_file_path_filtered.keys(), responses))))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+          _run_until_done(_submit_uploads(executor, self, remote_name_to_file_path_filtered, manifest=manifest, result=result))
+        logging.info("Uploaded %d files to %s; %d failures: %s", len(result["uploaded"]), self, len(result["failed"]), pprint.pformat(result["failed"]))
+        self.forget_item()
         # It is futile to do the below as archive.org says that the file does not exist for newly uploaded files.
         # for basename in remote_name_to_file_path_filtered.keys():
         #     self.update_mp3_metadata(mp3_file=basename_to_file[basename])
       else:
         logging.warning("Found nothing to update!")
+    if manifest is not None:
+      manifest.save()
+    return result
 
-  def update_from_dir(self, file_patterns=["*"], dry_run=False, overwrite_all=False):
+  def get_local_files(self, file_patterns=["*"]):
     file_paths = []
     for file_pattern in file_patterns:
       file_paths.extend([str(p) for p in Path(self.repo_base).glob("**/" + file_pattern)])
-    self.update_with_files(file_paths=file_paths, overwrite_all=overwrite_all, dry_run=dry_run)
+    return file_paths
+
+  def update_from_dir(self, file_patterns=["*"], dry_run=False, overwrite_all=False):
+    file_paths = self.get_local_files(file_patterns=file_patterns)
+    return self.update_with_files(file_paths=file_paths, overwrite_all=overwrite_all, dry_run=dry_run)
 
-  def download_original_files(self, destination_dir, file_prefix="", skip_existing=True):
-    import wget
+  def download_original_files(self, destination_dir, file_prefix="", skip_existing=True, workers=8, manifest=None):
+    """
+    Download the original files of the item concurrently. Existing local files are skipped if their size and md5 match the item's.
+
+    :param manifest: A FileManifest caching md5s of local files, so that unchanged files are not rehashed on every run. Defaults to a SYNC_MANIFEST_NAME file in destination_dir.
+    :return: The report of DownloadManager.download_all.
+    """
+    from curation_utils.file_helper.download_manager import DownloadManager
     os.makedirs(destination_dir, exist_ok=True)
-    urls = [os.path.join(self.archive_item.urls.download, x) for x in self.original_item_file_names]
-    for url in urls:
-      extension = os.path.splitext(url)[1]
-      remote_file_name = os.path.basename(url)
-      out_file = os.path.join(destination_dir, "%s%s" % (file_prefix, remote_file_name))
-      if not skip_existing or not os.path.exists(out_file):
-        logging.info("Getting %s as %s", url, out_file)
-        wget.download(url=url, out=out_file)
-      else:
-        logging.info("Skipping existing file %s", out_file)
+    downloads = []
+    for item_file in self.original_item_files:
+      remote_file_name = os.path.basename(item_file["name"])
+      downloads.append({
+        "url": os.path.join(self.archive_item.urls.download, item_file["name"]),
+        "path": os.path.join(destination_dir, "%s%s" % (file_prefix, remote_file_name)),
+        "size": item_file.get("size"),
+        "md5": item_file.get("md5")})
+    if manifest is None:
+      manifest = FileManifest(os.path.join(destination_dir, SYNC_MANIFEST_NAME), root_dir=destination_dir)
+    return DownloadManager(workers=workers, manifest=manifest).download_all(downloads, skip_existing=skip_existing)
+
 
+# Sessions by config file, shared across ArchiveItems.
+_sessions = {}
+_sessions_lock = threading.Lock()
 
-def update_item(item_id, dir_path, file_patterns=["*.mp3", "*.txt", "*.pdf"], metadata=None):
+
+def get_session(config_file_path):
+  with _sessions_lock:
+    if config_file_path not in _sessions:
+      _sessions[config_file_path] = internetarchive.get_session(config_file=config_file_path)
+    return _sessions[config_file_path]
+
+
+def _run_until_done(pending):
+  """
+  Wait on futures, each mapped to a callback which takes the completed future and returns further futures (mapped to their callbacks), until none remain.
+  """
+  while pending:
+    (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+      callback = pending.pop(future)
+      pending.update(callback(future))
+
+
+def _submit_uploads(executor, archive_item, uploads, manifest, result):
+  """
+  Submit uploads of files to an item. For a new item, the other files wait until the first one (along with the metadata) has created it.
+
+  :param result: A dict with "uploaded" and "failed" lists, to which outcomes are appended.
+  :return: Futures mapped to callbacks, for _run_until_done.
+  """
+  def submit(batch):
+    return {executor.submit(archive_item.upload_file, remote_name, file_path): functools.partial(on_uploaded, remote_name, file_path) for (remote_name, file_path) in batch}
+
+  def on_uploaded(remote_name, file_path, future, rest=()):
+    try:
+      future.result()
+      result["uploaded"].append(remote_name)
+      if manifest is not None:
+        local_md5 = manifest.get_md5(file_path)
+        manifest.record(file_path, md5=local_md5, uploaded_md5=local_md5)
+    except Exception as e:
+      logging.error("Failed to upload %s to %s: %s", file_path, archive_item, e)
+      result["failed"].append((remote_name, repr(e)))
+    return submit(rest)
+
+  uploads = list(uploads.items())
+  if len(uploads) == 0 or archive_item.archive_item.exists:
+    return submit(uploads)
+  (remote_name, file_path) = uploads[0]
+  return {executor.submit(archive_item.upload_file, remote_name, file_path): functools.partial(on_uploaded, remote_name, file_path, rest=uploads[1:])}
+
+
+def update_item(item_id, dir_path, file_patterns=DEFAULT_FILE_PATTERNS, metadata=None):
   logging.info(f"To {item_id} from {dir_path}")
   archive_item = ArchiveItem(archive_id=item_id,
                                         repo_base=dir_path, metadata=metadata)
-  archive_item.update_from_dir(file_patterns=file_patterns)
+  return archive_item.update_from_dir(file_patterns=file_patterns)
+
+
+def _plan_item(item_factory, spec, checksum):
+  archive_item = item_factory(archive_id=spec["item_id"], repo_base=spec["dir_path"], metadata=spec.get("metadata"))
+  file_paths = archive_item.get_local_files(file_patterns=spec.get("file_patterns", DEFAULT_FILE_PATTERNS))
+  (uploads, manifest) = archive_item.plan_uploads(file_paths=file_paths, checksum=checksum)
+  return (archive_item, uploads, manifest)
+
+
+def update_items(specs, max_workers=8, item_factory=ArchiveItem, checksum=True, dry_run=False):
+  """
+  Update many items concurrently - like update_item, with at most max_workers items being planned or files being uploaded at any time, across all items.
+
+  :param specs: An iterable of dicts with item_id, dir_path and optionally file_patterns and metadata.
+  :param item_factory: Makes items, given archive_id, repo_base and metadata.
+  :return: A dict from item id to a dict with the remote names planned for upload, the uploaded ones, (remote name, error) failures and the error (if any) which stopped the item from being planned.
+  """
+  summary = {}
+  archive_items = []
+  manifests = []
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    def on_planned(result, future):
+      try:
+        (archive_item, uploads, manifest) = future.result()
+      except Exception as e:
+        logging.error("Could not plan uploads to %s: %s", result["item_id"], e)
+        result["error"] = repr(e)
+        return {}
+      result["planned"] = sorted(uploads.keys())
+      archive_items.append(archive_item)
+      if manifest is not None:
+        manifests.append(manifest)
+      if dry_run:
+        return {}
+      return _submit_uploads(executor, archive_item, uploads, manifest=manifest, result=result)
+
+    pending = {}
+    for spec in specs:
+      result = {"item_id": spec["item_id"], "planned": [], "uploaded": [], "failed": [], "error": None}
+      summary[spec["item_id"]] = result
+      pending[executor.submit(_plan_item, item_factory, spec, checksum)] = functools.partial(on_planned, result)
+    _run_until_done(pending)
+  for manifest in manifests:
+    manifest.save()
+  for archive_item in archive_items:
+    if len(summary[archive_item.archive_id]["uploaded"]) > 0:
+      archive_item.forget_item()
+  logging.info("Uploaded %d files to %d items; %d files failed, %d items failed", sum(len(result["uploaded"]) for result in summary.values()), len(summary),
+               sum(len(result["failed"]) for result in summary.values()), sum(1 for result in summary.values() if result["error"] is not None))
+  return summary
@@ -1,9 +1,15 @@
 import codecs
+import errno
+import functools
 import glob
+import hashlib
+import itertools
 import logging
 import os, tempfile
 import re
 import shutil
+import stat
+import string
 import sys
 from pathlib import Path
 from urllib.parse import urlparse
@@ -15,8 +21,13 @@ from indic_transliteration import sanscript
 from indic_transliteration.sanscript.schemes import roman
 from collections import defaultdict
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from tqdm import tqdm
 
+from curation_utils.file_helper.manifest import FileManifest, get_md5
+from curation_utils.file_helper.rename_plan import RenamePlan
+
 for handler in logging.root.handlers[:]:
   logging.root.removeHandler(handler)
 logging.basicConfig(
@@ -35,20 +46,115 @@ def clear_bad_chars(s):
   return s
 
 
-def detect_encoding(file_path):
+def normalize_newlines(s):
+  """
+  Turn \r\n and lone \r into \n - as reading a file in text mode (with universal newlines) does.
+  """
+  return s.replace("\r\n", "\n").replace("\r", "\n")
+
+
+# The characters of re_chars_to_remove other than \r (which normalize_newlines takes care of), as utf-8. In valid utf-8, these byte sequences can only ever encode those characters.
+_bad_char_sequences_utf8 = tuple(c.encode("utf-8") for c in "\uFEFF\u00A0\u200b")
+UTF8_ENCODINGS = ["utf-8", "ascii"]
+
+
+def clear_bad_chars_utf8(data):
+  """
+  Equivalent to clear_bad_chars(normalize_newlines(data.decode("utf-8"))).encode("utf-8"), without decoding.
+
+  :param data: Valid utf-8 bytes.
+  """
+  # bytes.replace runs at memchr speed; it beats both bytes.translate and a regex here.
+  data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+  for sequence in _bad_char_sequences_utf8:
+    data = data.replace(sequence, b"")
+  return data
+
+
+def _utf8_complete_length(data, hold_cr=False):
+  """
+  :param hold_cr: Also leave out a final \r - which may be followed by \n in the next chunk.
+  :return: The length of the longest prefix of data not ending in a truncated utf-8 character.
+  """
+  if hold_cr and data.endswith(b"\r"):
+    return len(data) - 1
+  for i in range(1, min(4, len(data)) + 1):
+    byte = data[-i]
+    if byte < 0x80:
+      return len(data)
+    if byte >= 0xC0:
+      char_length = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+      return len(data) if char_length == i else len(data) - i
+  return len(data)
+
+
+NORMALIZATION_MANIFEST_NAME = ".normalization_manifest.jsonl"
+DETECTION_CHUNK_SIZE = 65536
+# Bytes fed to chardet at most, once the strict UTF-8 check has failed.
+DETECTION_BYTE_BUDGET = 1048576
+# Files larger than this are normalized chunk by chunk.
+STREAMING_THRESHOLD = 67108864
+STREAMING_CHUNK_SIZE = 1048576
+
+
+def is_utf8_file(file_path, chunk_size=DETECTION_CHUNK_SIZE):
+  """
+  Strictly validate file_path as UTF-8, streaming it in fixed size chunks.
+
+  :return: None if the file is not valid UTF-8, else "ascii" or "utf-8".
+  """
+  decoder = codecs.getincrementaldecoder("utf-8")(errors="strict")
+  is_ascii = True
+  with open(file_path, 'rb') as file:
+    while True:
+      chunk = file.read(chunk_size)
+      if not chunk:
+        break
+      if is_ascii and chunk.isascii():
+        continue
+      is_ascii = False
+      try:
+        decoder.decode(chunk)
+      except UnicodeDecodeError:
+        return None
+  try:
+    decoder.decode(b"", final=True)
+  except UnicodeDecodeError:
+    return None
+  return "ascii" if is_ascii else "utf-8"
+
+
+def detect_encoding(file_path, max_bytes=DETECTION_BYTE_BUDGET, chunk_size=DETECTION_CHUNK_SIZE):
+  """
+  Detect the encoding of a file without loading it into memory.
+
+  Valid UTF-8 (or plain ASCII) files are recognized by a streaming validation pass, without invoking chardet. Other files are fed to chardet chunk by chunk, till it is done or max_bytes have been fed.
+
+  :param max_bytes: Byte budget for chardet. None means no limit.
+  :param chunk_size: Size of the binary chunks read from the file.
+  :return: An encoding name, or None if chardet could not decide.
+  """
+  encoding = is_utf8_file(file_path=file_path, chunk_size=chunk_size)
+  if encoding is not None:
+    return encoding
   detector = UniversalDetector()
   detector.reset()
+  bytes_fed = 0
   with open(file_path, 'rb') as file:
-    for line in file.readlines():
-      detector.feed(line)
-      if detector.done: break
+    while not detector.done and (max_bytes is None or bytes_fed < max_bytes):
+      to_read = chunk_size if max_bytes is None else min(chunk_size, max_bytes - bytes_fed)
+      chunk = file.read(to_read)
+      if not chunk:
+        break
+      detector.feed(chunk)
+      bytes_fed += len(chunk)
   detector.close()
   return detector.result['encoding']
 
 
 def unicodify(file_path):
   encoding = detect_encoding(file_path=file_path)
-  if encoding == "utf-8":
+  if encoding in UTF8_ENCODINGS:
     return
   logging.info("From %s to utf-8: Converting %s", file_path, encoding)
   BLOCKSIZE = 1048576  # or some other, desired size in bytes
@@ -63,42 +169,271 @@ def unicodify(file_path):
   _ = shutil.move(tmp_file, file_path)
 
 
-def clear_bad_chars_in_file(file_path, dry_run=False):
-  try:
-    with open(file_path, 'r', encoding="utf-8") as file:
-      text = clear_bad_chars(s=file.read())
-  except Exception:
-    unicodify(file_path=file_path)
+def _normalization_report(file_path, **kwargs):
+  report = {"path": str(file_path), "encoding": None, "changed": False, "bytes_changed": 0, "md5": None, "skipped": False, "error": None}
+  report.update(kwargs)
+  return report
+
+
+def clear_bad_chars_in_stream(in_file, out_file, encoding, chunk_size=STREAMING_CHUNK_SIZE):
+  """
+  Decode in_file incrementally, clear bad chars and write the result to out_file as utf-8, one chunk at a time.
+
+  Multibyte sequences straddling chunk boundaries are carried over to the next chunk, as is a trailing \r (which may be the first half of a \r\n). utf-8 input is cleaned as bytes, without decoding.
+
+  :param in_file: A binary file object.
+  :param out_file: A binary file object, or None to only compute the returned summary.
+  :return: (md5 of the input, md5 of the output, number of bytes read, number of bytes written)
+  """
+  if encoding in UTF8_ENCODINGS:
+    decoder = None
+    carry = b""
+  else:
+    decoder = codecs.getincrementaldecoder(encoding)(errors="strict")
+    text_carry = ""
+  in_md5 = hashlib.md5()
+  out_md5 = hashlib.md5()
+  bytes_read = 0
+  bytes_written = 0
+  while True:
+    chunk = in_file.read(chunk_size)
+    final = not chunk
+    in_md5.update(chunk)
+    bytes_read += len(chunk)
+    if decoder is None:
+      chunk = carry + chunk
+      complete_length = len(chunk) if final else _utf8_complete_length(chunk, hold_cr=True)
+      carry = chunk[complete_length:]
+      cleaned = clear_bad_chars_utf8(chunk[:complete_length])
+    else:
+      text = text_carry + decoder.decode(chunk, final=final)
+      text_carry = ""
+      if not final and text.endswith("\r"):
+        (text, text_carry) = (text[:-1], "\r")
+      cleaned = clear_bad_chars(s=normalize_newlines(text)).encode("utf-8")
+    out_md5.update(cleaned)
+    bytes_written += len(cleaned)
+    if out_file is not None:
+      out_file.write(cleaned)
+    if final:
+      break
+  return (in_md5.hexdigest(), out_md5.hexdigest(), bytes_read, bytes_written)
+
+
+def _normalize_file_streaming(file_path, encoding, report, dry_run=False):
+  if dry_run:
+    with open(file_path, 'rb') as in_file:
+      (in_md5, out_md5, bytes_read, bytes_written) = clear_bad_chars_in_stream(in_file=in_file, out_file=None, encoding=encoding)
+  else:
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", suffix=os.path.splitext(file_path)[1], dir=os.path.dirname(os.path.abspath(file_path)))
     try:
-      with open(file_path, 'r', encoding="utf-8") as file:
-        text = clear_bad_chars(s=file.read())
-    except Exception:
-      logging.fatal(file_path)
-      sys.exit(1)
-  with open(file_path, 'w', encoding="utf-8") as file:
-    if not dry_run:
-      file.writelines(text)
+      with open(file_path, 'rb') as in_file, os.fdopen(fd, 'wb') as out_file:
+        (in_md5, out_md5, bytes_read, bytes_written) = clear_bad_chars_in_stream(in_file=in_file, out_file=out_file, encoding=encoding)
+      if in_md5 != out_md5:
+        shutil.copymode(file_path, tmp_path)
+        move_file_cross_device_safe(src=tmp_path, dst=str(file_path))
+    finally:
+      if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+  report["changed"] = in_md5 != out_md5
+  report["bytes_changed"] = bytes_written - bytes_read
+  if not report["changed"] or not dry_run:
+    report["md5"] = out_md5
+
+
+def normalize_file(file_path, dry_run=False, streaming=None):
+  """
+  Convert a file to utf-8 and clear bad chars in it. The file is not rewritten if that changes nothing.
+
+  Unlike clear_bad_chars_in_file, failures are reported rather than ending the process.
+
+  :param streaming: Process the file chunk by chunk, with flat memory use, writing to a temp file which atomically replaces the original. None means: only for files larger than STREAMING_THRESHOLD.
+  :return: A dict with the path, the detected encoding, whether the file changed, bytes_changed (size after minus size before), the md5 of the normalized content (None if it was not written), whether the file was skipped as known to be clean, and error (None on success).
+  """
+  report = _normalization_report(file_path)
+  try:
+    encoding = detect_encoding(file_path=file_path)
+    report["encoding"] = encoding
+    if encoding is None:
+      raise ValueError("Could not detect encoding")
+    if streaming is None:
+      streaming = os.path.getsize(file_path) > STREAMING_THRESHOLD
+    if streaming:
+      _normalize_file_streaming(file_path=file_path, encoding=encoding, report=report, dry_run=dry_run)
+      return report
+    with open(file_path, 'rb') as file:
+      original = file.read()
+    if encoding in UTF8_ENCODINGS:
+      cleaned = clear_bad_chars_utf8(original)
     else:
-      logging.info(text)
+      cleaned = clear_bad_chars(s=normalize_newlines(original.decode(encoding))).encode("utf-8")
+    report["changed"] = cleaned != original
+    report["bytes_changed"] = len(cleaned) - len(original)
+    if report["changed"] and not dry_run:
+      with open(file_path, 'wb') as file:
+        file.write(cleaned)
+    if not report["changed"] or not dry_run:
+      report["md5"] = hashlib.md5(cleaned).hexdigest()
+  except Exception as e:
+    logging.error("Could not normalize %s: %s", file_path, e)
+    report["error"] = repr(e)
+  return report
+
+
+def _normalize_file_unless_known(file_path, known_md5=None, dry_run=False):
+  if known_md5 is not None and get_md5(file_path) == known_md5:
+    return _normalization_report(file_path, md5=known_md5, skipped=True)
+  return normalize_file(file_path=file_path, dry_run=dry_run)
+
+
+def clear_bad_chars_in_file(file_path, dry_run=False, streaming=None):
+  report = normalize_file(file_path=file_path, dry_run=dry_run, streaming=streaming)
+  if report["error"] is not None:
+    logging.fatal(file_path)
+    sys.exit(1)
+  if dry_run and report["changed"]:
+    logging.info("Would change %s (%+d bytes)", file_path, report["bytes_changed"])
+
+
+def normalize_tree(dir_path, pattern="**/*", workers=None, dry_run=False, manifest_name=NORMALIZATION_MANIFEST_NAME):
+  """
+  Run normalize_file on every file matching pattern under dir_path, using a pool of worker processes.
+
+  Files known to be clean are recorded in a manifest under dir_path. Those whose size and mtime are unchanged on later runs are skipped without being read; those whose stat changed but whose content hash did not are skipped without being rewritten.
+
+  :param workers: Number of worker processes. None means os.cpu_count(); 1 means work in this process.
+  :param manifest_name: File name of the manifest within dir_path. None disables it.
+  :return: A list of normalize_file reports, sorted by path.
+  """
+  manifest = FileManifest(os.path.join(dir_path, manifest_name), root_dir=dir_path) if manifest_name is not None else None
+  reports = []
+  file_paths = []
+  known_md5s = []
+  for path in sorted(Path(dir_path).glob(pattern)):
+    if not path.is_file() or (manifest is not None and path.name == manifest_name):
+      continue
+    file_path = str(path)
+    known_md5 = None
+    if manifest is not None:
+      entry = manifest.get_entry(file_path)
+      if entry is not None:
+        file_stat = path.stat()
+        if entry["size"] == file_stat.st_size and entry["mtime_ns"] == file_stat.st_mtime_ns:
+          reports.append(_normalization_report(file_path, md5=entry["md5"], skipped=True))
+          continue
+        if entry["size"] == file_stat.st_size:
+          known_md5 = entry["md5"]
+    file_paths.append(file_path)
+    known_md5s.append(known_md5)
+  logging.info("Normalizing %d files under %s, %d known to be clean", len(file_paths), dir_path, len(reports))
+  normalize = functools.partial(_normalize_file_unless_known, dry_run=dry_run)
+  if workers == 1:
+    new_reports = [normalize(file_path, known_md5) for (file_path, known_md5) in tqdm(list(zip(file_paths, known_md5s)))]
+  elif len(file_paths) > 0:
+    workers = workers or os.cpu_count()
+    # Large chunks amortize inter-process overhead; small ones keep the workers evenly loaded.
+    chunksize = max(1, min(64, len(file_paths) // (workers * 4)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      new_reports = list(tqdm(executor.map(normalize, file_paths, known_md5s, chunksize=chunksize), total=len(file_paths)))
+  else:
+    new_reports = []
+  if manifest is not None:
+    for report in new_reports:
+      if report["error"] is None and report["md5"] is not None:
+        manifest.record(report["path"], md5=report["md5"])
+    manifest.save()
+  reports.extend(new_reports)
+  reports.sort(key=lambda report: report["path"])
+  failures = [report for report in reports if report["error"] is not None]
+  logging.info("Changed %d of %d files, %d failures", len([report for report in reports if report["changed"]]), len(reports), len(failures))
+  return reports
 
 
 def concatenate_files(input_path_list, output_path, add_newline_inbetween=False):
+  """
+  Concatenate files, copying inside the kernel (see copy_fd_range) at tracked output offsets.
+
+  :param add_newline_inbetween: Write a newline after each input file.
+  Raises OSError if an input file ends before the size it had when opened.
+  """
   os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
   with open(output_path, 'wb') as outfile:
+    out_fd = outfile.fileno()
+    offset = 0
     for f in input_path_list:
       with open(f, 'rb') as fd:
-        shutil.copyfileobj(fd, outfile)
+        in_fd = fd.fileno()
+        in_stat = os.fstat(in_fd)
+        if stat.S_ISREG(in_stat.st_mode):
+          copied = copy_fd_range(in_fd, out_fd, count=in_stat.st_size, out_offset=offset)
+          if copied != in_stat.st_size:
+            raise OSError("Copied only %d of %d bytes of %s to %s" % (copied, in_stat.st_size, f, output_path))
+          offset += copied
+        else:
+          # Pipes and the like have no size to copy up to.
+          for data in iter(lambda: fd.read(COPY_BUFFER_SIZE), b""):
+            offset += os.pwrite(out_fd, data, offset)
       if add_newline_inbetween:
-        outfile.write("\n".encode())
+        offset += os.pwrite(out_fd, b"\n", offset)
+
+
+def concatenate_files_batch(output_path_to_input_paths, add_newline_inbetween=False, workers=8):
+  """
+  Build many concatenated files concurrently.
+
+  :param output_path_to_input_paths: A dict from each output path to the list of paths to concatenate into it.
+  :param workers: Number of threads, each building one output at a time.
+  :return: A dict from each output path to None on success, or the error.
+  """
+  def concatenate(output_path):
+    try:
+      concatenate_files(input_path_list=output_path_to_input_paths[output_path], output_path=output_path, add_newline_inbetween=add_newline_inbetween)
+      return None
+    except OSError as e:
+      logging.error("Could not build %s: %s", output_path, e)
+      return repr(e)
+
+  output_paths = list(output_path_to_input_paths.keys())
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    errors = list(executor.map(concatenate, output_paths))
+  logging.info("Built %d files, %d failures", len(output_paths), len([e for e in errors if e is not None]))
+  return dict(zip(output_paths, errors))
+
+
+class _FilePathCharTable(dict):
+  """
+  A str.translate table deleting every character other than ASCII letters, digits and " _-~./". Filled in lazily, once per distinct character.
+  """
+  allowed_chars = frozenset(string.ascii_letters + string.digits + " _-~./")
+
+  def __missing__(self, key):
+    value = key if chr(key) in self.allowed_chars else None
+    self[key] = value
+    return value
+
+
+_file_path_char_table = _FilePathCharTable()
+# After the translation above, the only whitespace left is " ".
+_re_avagraha = re.compile(r"([^ ])\.a")
+_re_underscore_run = re.compile(r"([ _]+)([./]?)")
+
+
+def _fix_underscore_run(match):
+  (run, terminator) = match.groups()
+  # Space runs become "_", then underscore runs become "__"; so a run ends up as a single "_" only if it is all spaces or a lone "_".
+  replacement = "_" if run == "_" or not run.strip(" ") else "__"
+  if terminator:
+    return replacement[1:] + terminator
+  return replacement
 
 
 def clean_file_path(file_path):
-  file_path_out = regex.sub("[^a-zA-Z0-9 _\\-~./]", "", file_path.strip())
+  file_path_out = file_path.strip().translate(_file_path_char_table)
   # Handle avagrahas
-  file_path_out = regex.sub(r"(\S)\.a", "\\1-", file_path_out)
-  file_path_out = regex.sub(" +", "_", file_path_out)
-  file_path_out = regex.sub("__+", "__", file_path_out)
-  file_path_out = regex.sub("_([./])", "\\1", file_path_out)
+  if ".a" in file_path_out:
+    file_path_out = _re_avagraha.sub("\\1-", file_path_out)
+  if " " in file_path_out or "__" in file_path_out or "_." in file_path_out or "_/" in file_path_out:
+    file_path_out = _re_underscore_run.sub(_fix_underscore_run, file_path_out)
   return file_path_out
 
 
@@ -110,40 +445,248 @@ def clean_file_name(name):
   return ".".join(fixed_parts)
 
 
-def clean_file_names(dir_path, dry_run=False):
-  paths = list(Path(dir_path).glob("**/*"))
-  logging.info("Got %d paths", len(paths))
-  for path in paths:
-    path = str(path)
-    # logging.debug("Checking '%s'", path)
-    dest_path = clean_file_path(path)
-    if path != dest_path:
-      logging.info("Changing '%s' to '%s'", path, dest_path)
-      if not dry_run:
+def _walk_bottom_up(dir_path):
+  """
+  Yield (parent_dir_path, name) for every entry under dir_path, the contents of each directory before the directory itself.
+
+  Only the listings of the directories along the current path are held in memory.
+  """
+  try:
+    with os.scandir(dir_path) as entries:
+      listing = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in entries]
+  except OSError as e:
+    logging.error("Could not list %s: %s", dir_path, e)
+    return
+  for (name, is_dir) in listing:
+    if is_dir:
+      yield from _walk_bottom_up(os.path.join(dir_path, name))
+  for (name, _) in listing:
+    yield (dir_path, name)
+
+
+def clean_file_names(dir_path, dry_run=False, log_every=10000):
+  """
+  Rename every file and directory under dir_path to clean_file_path of its name.
+
+  Renames go bottom-up, so no path is stale by the time it is renamed. Entries whose clean name is empty or already taken are skipped.
+
+  :param log_every: Log progress after checking this many paths.
+  :return: A dict with counts of paths checked, renamed, skipped and failed.
+  """
+  counts = {"checked": 0, "renamed": 0, "skipped": 0, "failed": 0}
+  for (parent_path, name) in _walk_bottom_up(dir_path):
+    counts["checked"] += 1
+    if counts["checked"] % log_every == 0:
+      logging.info("Checked %d paths under %s: %s", counts["checked"], dir_path, counts)
+    dest_name = clean_file_path(name)
+    if dest_name == name:
+      continue
+    path = os.path.join(parent_path, name)
+    dest_path = os.path.join(parent_path, dest_name)
+    if dest_name in ["", ".", ".."] or os.path.lexists(dest_path):
+      logging.warning("Not changing '%s' to '%s'", path, dest_path)
+      counts["skipped"] += 1
+      continue
+    logging.debug("Changing '%s' to '%s'", path, dest_path)
+    if not dry_run:
+      try:
         os.rename(path, dest_path)
+      except OSError as e:
+        logging.error("Could not change '%s' to '%s': %s", path, dest_path, e)
+        counts["failed"] += 1
+        continue
+    counts["renamed"] += 1
+  logging.info("Checked %d paths under %s: %s", counts["checked"], dir_path, counts)
+  return counts
 
 
-def copy_file_tree(source_dir, dest_dir, file_pattern, file_name_filter=None):
+# copy_file_range/sendfile failing with these just means "not supported here" - fall back to something simpler.
+_KERNEL_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.EPERM}
+COPY_BUFFER_SIZE = 1048576
+
+
+def copy_fd_range(in_fd, out_fd, count, in_offset=0, out_offset=0):
+  """
+  Copy count bytes from in_offset in in_fd to out_offset in out_fd, inside the kernel where possible.
+
+  Tries os.copy_file_range (which can reflink on btrfs/XFS), then os.sendfile, then falls back to pread/pwrite.
+
+  :return: Number of bytes copied - less than count only if in_fd ended early.
+  """
+  copied = 0
+  # Some kernels and filesystems (cross-filesystem copies on Linux 5.3 to 5.18, some FUSE and network filesystems) have copy_file_range (or sendfile) return 0 for non-empty files. So a 0 before anything is copied is not taken as the end of in_fd, but as a cue to fall back - as shutil does.
+  if hasattr(os, "copy_file_range"):
+    try:
+      while copied < count:
+        n = os.copy_file_range(in_fd, out_fd, count - copied, in_offset + copied, out_offset + copied)
+        if n == 0:
+          break
+        copied += n
+      if copied > 0 or count == 0:
+        return copied
+    except OSError as e:
+      if e.errno not in _KERNEL_COPY_FALLBACK_ERRNOS:
+        raise
+  if hasattr(os, "sendfile"):
+    try:
+      # sendfile writes at the current position of out_fd.
+      os.lseek(out_fd, out_offset + copied, os.SEEK_SET)
+      while copied < count:
+        n = os.sendfile(out_fd, in_fd, in_offset + copied, count - copied)
+        if n == 0:
+          break
+        copied += n
+      if copied > 0 or count == 0:
+        return copied
+    except OSError as e:
+      if e.errno not in _KERNEL_COPY_FALLBACK_ERRNOS:
+        raise
+  while copied < count:
+    data = os.pread(in_fd, min(COPY_BUFFER_SIZE, count - copied), in_offset + copied)
+    if not data:
+      return copied
+    os.pwrite(out_fd, data, out_offset + copied)
+    copied += len(data)
+  return copied
+
+
+def copy_file(source_path, dest_path, source_stat=None):
+  """
+  Copy a file's contents with copy_fd_range, and its mtime, so that later syncs can recognize it as unchanged.
+
+  :return: Number of bytes copied. Raises OSError if the source ended early.
+  """
+  if source_stat is None:
+    source_stat = os.stat(source_path)
+  with open(source_path, 'rb') as in_file, open(dest_path, 'wb') as out_file:
+    copied = copy_fd_range(in_file.fileno(), out_file.fileno(), count=source_stat.st_size)
+  if copied != source_stat.st_size:
+    # Not stamping the source's mtime, so that a later sync copies it again.
+    raise OSError("Copied only %d of %d bytes of %s to %s" % (copied, source_stat.st_size, source_path, dest_path))
+  os.utime(dest_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+  return copied
+
+
+def _is_copy_unchanged(source_path, source_stat, dest_path, compare_content=False):
+  try:
+    dest_stat = os.stat(dest_path)
+  except FileNotFoundError:
+    return False
+  if dest_stat.st_size != source_stat.st_size:
+    return False
+  if compare_content:
+    return get_md5(source_path) == get_md5(dest_path)
+  return dest_stat.st_mtime_ns == source_stat.st_mtime_ns
+
+
+def copy_file_tree(source_dir, dest_dir, file_pattern, file_name_filter=None, skip_unchanged=True, compare_content=False, workers=8):
+  """
+  Copy files matching file_pattern under source_dir to the same relative paths under dest_dir, rsync style.
+
+  :param skip_unchanged: Skip files whose destination has the same size and mtime (copies preserve mtime).
+  :param compare_content: With skip_unchanged, compare md5 hashes instead of mtimes.
+  :param workers: Number of threads copying concurrently.
+  :return: A dict with counts of files and bytes copied and skipped, and a list of (path, error) failures.
+  """
   file_paths = sorted(filter(file_name_filter, Path(source_dir).glob(file_pattern)))
-  for file_path in file_paths:
-    dest_path = str(file_path).replace(source_dir, dest_dir)
+
+  def copy(file_path):
+    source_stat = os.stat(file_path)
+    if not stat.S_ISREG(source_stat.st_mode):
+      return None
+    dest_path = os.path.join(dest_dir, os.path.relpath(file_path, source_dir))
+    if skip_unchanged and _is_copy_unchanged(source_path=file_path, source_stat=source_stat, dest_path=dest_path, compare_content=compare_content):
+      return (False, source_stat.st_size)
     os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-    logging.info("Moving %s to %s", file_path, dest_path)
-    _ = shutil.copyfile(file_path, dest_path)
+    logging.info("Copying %s to %s", file_path, dest_path)
+    return (True, copy_file(source_path=file_path, dest_path=dest_path, source_stat=source_stat))
+
+  def copy_safely(file_path):
+    try:
+      return (file_path, copy(file_path), None)
+    except OSError as e:
+      logging.error("Could not copy %s: %s", file_path, e)
+      return (file_path, None, repr(e))
+
+  report = {"copied": 0, "skipped": 0, "bytes_copied": 0, "bytes_skipped": 0, "failed": []}
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    for (file_path, result, error) in executor.map(copy_safely, file_paths):
+      if error is not None:
+        report["failed"].append((str(file_path), error))
+      elif result is not None:
+        (copied, size) = result
+        report["copied" if copied else "skipped"] += 1
+        report["bytes_copied" if copied else "bytes_skipped"] += size
+  logging.info("Copied %d files (%d bytes), skipped %d unchanged files (%d bytes), %d failures", report["copied"], report["bytes_copied"], report["skipped"], report["bytes_skipped"], len(report["failed"]))
+  return report
+
+
+# Downloads are written in chunks of this size, rather than a write call every few bytes.
+DOWNLOAD_CHUNK_SIZE = 1048576
+# (connect, read) timeouts for downloads, in seconds.
+DOWNLOAD_TIMEOUT = (30, 300)
+
+
+def _get_remote_size(http, url, response, timeout):
+  """
+  :param response: A 416 response, whose Content-Range (bytes */N) should give the size - else a HEAD request is made.
+  :return: The size of the remote file, or None if unknown.
+  """
+  content_range = regex.fullmatch(r"bytes \*/(\d+)", response.headers.get("Content-Range", "").strip())
+  if content_range is not None:
+    return int(content_range.group(1))
+  head_response = http.head(url, timeout=timeout, allow_redirects=True)
+  if head_response.ok and "Content-Length" in head_response.headers:
+    return int(head_response.headers["Content-Length"])
+  return None
 
 
-def download_file(url: str, filepath: str = None):
+def download_file(url: str, filepath: str = None, session=None, chunk_size=DOWNLOAD_CHUNK_SIZE, timeout=DOWNLOAD_TIMEOUT, resume=True, md5=None):
   ''' Download file from url to specified filepath.
       If filepath is None, then the file is saved in the current directory
       and the path is returned.
+
+      The download goes to filepath + ".part", which is renamed to filepath only once complete (and verified, if md5 is given). With resume, an existing .part file is continued with an HTTP Range request - or restarted, if the server ignores the range or the .part file is not a prefix-sized part of the remote file.
+
+      :param session: A requests.Session, so that batch downloads reuse connections.
+      :param md5: Expected md5 hex digest. On mismatch, the .part file is removed and ValueError raised.
   '''
   if filepath is None:
     path = urlparse(url).path
     filepath = Path(path).name
-  r = requests.get(url, stream=True)
-  with open(filepath, "wb") as fd:
-    for chunk in r.iter_content(chunk_size=128):
-      fd.write(chunk)
+  filepath = str(filepath)
+  part_path = filepath + ".part"
+  offset = os.path.getsize(part_path) if resume and os.path.exists(part_path) else 0
+  http = session if session is not None else requests
+  while True:
+    headers = {"Range": "bytes=%d-" % offset} if offset > 0 else {}
+    with http.get(url, stream=True, timeout=timeout, headers=headers) as response:
+      if offset > 0 and response.status_code == 416:
+        # Nothing beyond offset. The .part file is complete only if it is exactly as long as the remote file.
+        remote_size = _get_remote_size(http=http, url=url, response=response, timeout=timeout)
+        if remote_size == offset:
+          logging.info("%s already fully downloaded", part_path)
+          break
+        logging.info("%s has %d bytes, but the remote file %s; restarting", part_path, offset, "has %d" % remote_size if remote_size is not None else "size is unknown")
+        os.remove(part_path)
+        offset = 0
+        continue
+      response.raise_for_status()
+      if offset > 0 and response.status_code != 206:
+        logging.info("Server ignored the range request; restarting %s", url)
+        offset = 0
+      elif offset > 0:
+        logging.info("Resuming %s at byte %d", url, offset)
+      with open(part_path, "ab" if offset > 0 else "wb") as fd:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+          fd.write(chunk)
+    break
+  if md5 is not None:
+    actual_md5 = get_md5(part_path)
+    if actual_md5 != md5:
+      os.remove(part_path)
+      raise ValueError("md5 mismatch for %s: expected %s, got %s" % (url, md5, actual_md5))
+  os.replace(part_path, filepath)
   return filepath
 
 
@@ -160,6 +703,11 @@ def remove_empty_dirs(path):
       remove_dir_if_empty(os.path.realpath(os.path.join(root, dirname)))
 
 
+# Parent directory names recur for every file beneath them, so transliterations are memoized.
+STORAGE_NAME_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=STORAGE_NAME_CACHE_SIZE)
 def get_storage_name(text, source_script=None, max_length=50, maybe_use_dravidian_variant="yes", mixed_languages_in_titles=True):
   from indic_transliteration import detect
   if source_script is None:
@@ -187,32 +735,83 @@ def get_storage_name(text, source_script=None, max_length=50, maybe_use_dravidia
   return storage_name
 
 
-def get_storage_path(file_path, source_script, max_length=50, mixed_languages_in_titles=True,
-                     maybe_use_dravidian_variant="no"):
+def get_storage_names(texts, source_script=None, max_length=50, maybe_use_dravidian_variant="yes", mixed_languages_in_titles=True):
+  """
+  get_storage_name for many texts, transliterating each distinct text only once.
+
+  :return: A dict from each distinct text to its storage name.
+  """
+  return {text: get_storage_name(text, source_script=source_script, max_length=max_length, maybe_use_dravidian_variant=maybe_use_dravidian_variant, mixed_languages_in_titles=mixed_languages_in_titles) for text in dict.fromkeys(texts)}
+
+
+def _split_storage_path(file_path):
   texts = file_path.split("/")
   (basename, extension) = os.path.splitext(texts[-1])
   texts[-1] = basename
+  return (texts, extension)
+
+
+def get_storage_path(file_path, source_script, max_length=50, mixed_languages_in_titles=True,
+                     maybe_use_dravidian_variant="no"):
+  (texts, extension) = _split_storage_path(file_path)
   return "/".join([get_storage_name(x, source_script=source_script, max_length=max_length, maybe_use_dravidian_variant=maybe_use_dravidian_variant, mixed_languages_in_titles=mixed_languages_in_titles) for x in texts]) + extension
 
 
-def rename_files_with_storage_name(dir_path, source_script=None, dry_run=False, max_length=20):
-  pass
-  paths = reversed(sorted(list(Path(dir_path).glob("**/*"))))
-  logging.info("Got %d paths", len(paths))
-  dest_paths = []
-  for fpath in paths:
-    fpath = str(fpath)
-    dest_path = get_storage_path(fpath, source_script=source_script, max_length=max_length)
-    if fpath != dest_path:
+def get_storage_paths(file_paths, source_script, max_length=50, mixed_languages_in_titles=True,
+                      maybe_use_dravidian_variant="no"):
+  """
+  get_storage_path for many paths, transliterating each distinct path component only once.
+
+  :return: A list of storage paths, in the order of file_paths.
+  """
+  split_paths = [_split_storage_path(file_path) for file_path in file_paths]
+  names = get_storage_names(itertools.chain.from_iterable(texts for (texts, _) in split_paths), source_script=source_script, max_length=max_length, maybe_use_dravidian_variant=maybe_use_dravidian_variant, mixed_languages_in_titles=mixed_languages_in_titles)
+  return ["/".join(names[text] for text in texts) + extension for (texts, extension) in split_paths]
+
+
+def plan_storage_renames(dir_path, source_script=None, max_length=20):
+  """
+  Compute, without touching the disk, the renames which give every file and directory under dir_path its storage name.
+
+  Names colliding with an existing or already planned name in the same directory get a __2, __3 .. suffix.
+
+  :return: A RenamePlan.
+  """
+  plan = RenamePlan()
+  for (root, dir_names, file_names) in os.walk(dir_path, topdown=False):
+    names = dir_names + file_names
+    taken_names = set(names)
+    new_names = get_storage_paths(names, source_script=source_script, max_length=max_length)
+    for (name, new_name) in zip(names, new_names):
+      if new_name == name:
+        continue
+      (basename, extension) = os.path.splitext(new_name)
+      if basename == "":
+        logging.warning("Empty storage name for '%s', leaving it be.", os.path.join(root, name))
+        continue
       i = 1
-      basename, extension = os.path.splitext(dest_path)
-      while os.path.exists(dest_path) or dest_path in dest_paths:
+      while new_name in taken_names:
         i += 1
-        dest_path = f"{basename}__{i}{extension}"
-      logging.info("Changing '%s' to '%s'", fpath, dest_path)
-      dest_paths.append(dest_path)
-      if not dry_run:
-        os.rename(fpath, dest_path)
+        new_name = f"{basename}__{i}{extension}"
+      taken_names.add(new_name)
+      plan.add(os.path.join(root, name), os.path.join(root, new_name))
+  return plan
+
+
+def rename_files_with_storage_name(dir_path, source_script=None, dry_run=False, max_length=20, plan_path=None, workers=1):
+  """
+  Give every file and directory under dir_path its storage name.
+
+  :param plan_path: If given, the rename plan is saved here as JSON - usable later with RenamePlan.load(plan_path).undo().
+  :param workers: Number of threads renaming entries at the same depth concurrently.
+  :return: The RenamePlan.
+  """
+  plan = plan_storage_renames(dir_path=dir_path, source_script=source_script, max_length=max_length)
+  logging.info("Planned %d renames under %s", len(plan), dir_path)
+  if plan_path is not None:
+    plan.save(plan_path)
+  plan.apply(dry_run=dry_run, workers=workers)
+  return plan
 
 
 def substitute_with_latest(paths_in, latest_file_paths, dry_run=False):
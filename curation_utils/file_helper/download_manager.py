@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import backoff
+import requests
+from tqdm import tqdm
+
+from curation_utils.file_helper.manifest import get_md5
+
+
+def _is_permanent_error(e):
+  """Client errors (other than timeouts and rate limiting) won't go away on retrying."""
+  response = getattr(e, "response", None)
+  return response is not None and 400 <= response.status_code < 500 and response.status_code not in [408, 429]
+
+
+def is_downloaded(file_path, size=None, md5=None, manifest=None):
+  """
+  Whether file_path exists and matches the expected size and md5 (when given).
+
+  :param manifest: A FileManifest caching md5s of local files.
+  """
+  if not os.path.exists(file_path):
+    return False
+  if size is not None and os.path.getsize(file_path) != int(size):
+    return False
+  if md5 is not None:
+    local_md5 = manifest.get_md5(file_path) if manifest is not None else get_md5(file_path)
+    if local_md5 != md5:
+      return False
+  return True
+
+
+def _download_file(url, path, size=None, md5=None, session=None):
+  """
+  file_helper.download_file, followed by a check of the size (when given) of the downloaded file.
+  """
+  from curation_utils import file_helper
+  file_helper.download_file(url, path, session=session, md5=md5)
+  if size is not None and os.path.getsize(path) != int(size):
+    actual_size = os.path.getsize(path)
+    os.remove(path)
+    raise ValueError("Size mismatch for %s: expected %s, got %d" % (url, size, actual_size))
+
+
+class DownloadManager(object):
+  """
+  Downloads many files concurrently over a shared pool of connections, with per-host limits, retries with backoff, resumption of partial downloads and skipping of files already present (judged by size and md5, when known).
+
+  Usage:
+    report = DownloadManager(workers=8).download_all([{"url": url, "path": path, "size": 123, "md5": "..."}])
+  """
+
+  def __init__(self, workers=8, max_per_host=4, max_tries=5, session=None, manifest=None):
+    """
+
+    :param workers: Number of concurrent downloads.
+    :param max_per_host: Bound on concurrent downloads from any single host.
+    :param max_tries: Attempts per file, with exponential backoff in between. Client errors (404 and such) are not retried.
+    :param manifest: A FileManifest, to avoid rehashing unchanged local files when checking md5s.
+    """
+    self.workers = workers
+    self.max_per_host = max_per_host
+    self.max_tries = max_tries
+    self.manifest = manifest
+    if session is None:
+      session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+      session.mount("http://", adapter)
+      session.mount("https://", adapter)
+    self.session = session
+    # md5 and size mismatches (ValueError) are retried too, as the bad file is discarded on mismatch.
+    self._download_file = backoff.on_exception(backoff.expo, (requests.RequestException, ValueError), max_tries=max_tries,
+                                               giveup=_is_permanent_error, factor=2, max_value=60)(_download_file)
+    self._host_semaphores = {}
+    self._lock = threading.Lock()
+
+  def _get_host_semaphore(self, url):
+    host = urlparse(url).netloc
+    with self._lock:
+      semaphore = self._host_semaphores.get(host)
+      if semaphore is None:
+        semaphore = threading.BoundedSemaphore(self.max_per_host)
+        self._host_semaphores[host] = semaphore
+    return semaphore
+
+  def download(self, url, path, size=None, md5=None, skip_existing=True):
+    """
+    Download url to path, unless already there.
+
+    :return: A dict with the url, path, status ("downloaded", "skipped" or "failed"), bytes transferred and error, if any.
+    """
+    result = {"url": url, "path": path, "status": "skipped", "bytes": 0, "error": None}
+    if skip_existing and is_downloaded(path, size=size, md5=md5, manifest=self.manifest):
+      logging.debug("Skipping existing file %s", path)
+      return result
+    dir_path = os.path.dirname(path)
+    if dir_path:
+      os.makedirs(dir_path, exist_ok=True)
+    part_path = path + ".part"
+    try:
+      # Bytes already in a .part file are not transferred again.
+      resumed_bytes = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+      with self._get_host_semaphore(url):
+        logging.info("Getting %s as %s", url, path)
+        self._download_file(url, path, size=size, md5=md5, session=self.session)
+      result["status"] = "downloaded"
+      result["bytes"] = os.path.getsize(path) - resumed_bytes
+      if self.manifest is not None and md5 is not None:
+        self.manifest.record(path, md5=md5)
+    except Exception as e:
+      logging.error("Failed to download %s: %s", url, e)
+      result["status"] = "failed"
+      result["error"] = repr(e)
+    return result
+
+  def download_all(self, downloads, skip_existing=True):
+    """
+
+    :param downloads: An iterable of dicts with url and path, and optionally the expected size and md5.
+    :return: A report dict: counts of downloaded, skipped and failed files, bytes transferred, seconds taken, bytes_per_second, and per-file results.
+    """
+    downloads = list(downloads)
+    start = time.time()
+    results = []
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      futures = [executor.submit(self.download, url=item["url"], path=item["path"], size=item.get("size"), md5=item.get("md5"), skip_existing=skip_existing) for item in downloads]
+      for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading", unit=" files"):
+        results.append(future.result())
+    seconds = time.time() - start
+    report = {status: sum(1 for result in results if result["status"] == status) for status in ["downloaded", "skipped", "failed"]}
+    report["bytes"] = sum(result["bytes"] for result in results)
+    report["seconds"] = seconds
+    report["bytes_per_second"] = report["bytes"] / seconds if seconds > 0 else 0
+    report["results"] = results
+    logging.info("Downloaded %d files (%.1f MB) in %.1f s, at %.2f MB/s; skipped %d, failed %d", report["downloaded"], report["bytes"] / 1048576, seconds, report["bytes_per_second"] / 1048576, report["skipped"], report["failed"])
+    if self.manifest is not None:
+      self.manifest.save()
+    return report
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+
+def get_md5(file_path, chunk_size=1048576):
+  md5 = hashlib.md5()
+  with open(file_path, 'rb') as file:
+    while True:
+      chunk = file.read(chunk_size)
+      if not chunk:
+        break
+      md5.update(chunk)
+  return md5.hexdigest()
+
+
+class FileManifest(object):
+  """
+  A JSON-lines record of files under a root directory, with the size, mtime and md5 each file had when it was recorded.
+
+  Lets repeated runs over a large tree skip files whose stat has not changed, without reading them.
+  """
+
+  def __init__(self, manifest_path, root_dir=None):
+    """
+
+    :param manifest_path: Path of the JSON-lines file. Need not exist yet.
+    :param root_dir: Paths are recorded relative to this directory. Defaults to the directory containing manifest_path.
+    """
+    self.manifest_path = str(manifest_path)
+    self.root_dir = str(root_dir) if root_dir is not None else os.path.dirname(os.path.abspath(self.manifest_path))
+    self._root_prefix = os.path.join(os.path.abspath(self.root_dir), "")
+    self.entries = {}
+    self.load()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def _key(self, file_path):
+    file_path = os.path.abspath(file_path)
+    if file_path.startswith(self._root_prefix):
+      return file_path[len(self._root_prefix):]
+    return os.path.relpath(file_path, self._root_prefix)
+
+  def load(self):
+    self.entries = {}
+    if not os.path.exists(self.manifest_path):
+      return
+    with open(self.manifest_path, 'r', encoding="utf-8") as file:
+      for line in file:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          logging.warning("Skipping corrupt manifest line in %s: %s", self.manifest_path, line)
+          continue
+        self.entries[entry["path"]] = entry
+    logging.debug("Loaded %d entries from %s", len(self.entries), self.manifest_path)
+
+  def save(self):
+    """
+    Atomically replace the manifest file with the current entries.
+    """
+    dir_path = os.path.dirname(os.path.abspath(self.manifest_path))
+    os.makedirs(dir_path, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", suffix=".jsonl", dir=dir_path)
+    try:
+      with os.fdopen(fd, 'w', encoding="utf-8") as file:
+        for entry in self.entries.values():
+          file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+      os.replace(tmp_path, self.manifest_path)
+    except Exception:
+      if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+      raise
+
+  def get_entry(self, file_path):
+    """
+    :return: The recorded entry for file_path, whether or not the file has changed since, or None.
+    """
+    return self.entries.get(self._key(file_path))
+
+  def get_fresh_entry(self, file_path, stat=None):
+    """
+    :return: The recorded entry for file_path if its size and mtime are unchanged, else None.
+    """
+    entry = self.get_entry(file_path)
+    if entry is None:
+      return None
+    if stat is None:
+      stat = os.stat(file_path)
+    if entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+      return None
+    return entry
+
+  def record(self, file_path, md5, stat=None, **fields):
+    """
+
+    :param fields: Further (JSON serializable) fields to keep in the entry.
+    """
+    if stat is None:
+      stat = os.stat(file_path)
+    key = self._key(file_path)
+    self.entries[key] = dict(fields, path=key, size=stat.st_size, mtime_ns=stat.st_mtime_ns, md5=md5)
+
+  def remove(self, file_path):
+    self.entries.pop(self._key(file_path), None)
+
+  def get_md5(self, file_path):
+    """
+    Get the md5 of file_path, computing (and recording) it only if the file changed since it was last recorded.
+    """
+    stat = os.stat(file_path)
+    entry = self.get_fresh_entry(file_path, stat=stat)
+    if entry is not None:
+      return entry["md5"]
+    md5 = get_md5(file_path)
+    # Keep any further fields of a stale entry.
+    fields = {name: value for (name, value) in (self.get_entry(file_path) or {}).items() if name not in ["path", "size", "mtime_ns", "md5"]}
+    self.record(file_path, md5=md5, stat=stat, **fields)
+    return md5
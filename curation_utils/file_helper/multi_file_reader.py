@@ -1,11 +1,42 @@
+import bisect
+import functools
 import io
+import json
+import mmap
 import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from builtins import open as fopen
 
 
+# Default bound on simultaneously open member files, in lazy mode.
+DEFAULT_MAX_OPEN_FILES = 64
+# Default bound on live memory maps, in mmap mode.
+DEFAULT_MAX_MAPPINGS = 256
+# Default size of the byte ranges handed to workers by map_records.
+DEFAULT_RANGE_SIZE = 4194304
+
+
 class MultiFileReader(io.BufferedIOBase):
+  """
+  Reads a sequence of files as one seekable binary stream.
+
+  The file holding a given offset is found by bisecting the files' start offsets, and reads fill a single preallocated buffer via readinto. Suitable for wrapping with io.TextIOWrapper.
+
+  With lazy=True, member files are opened only when first read, and at most max_open_files of them are kept open (least recently used ones are closed), so that corpora larger than the process fd limit can be read as one stream.
+
+  With use_mmap=True, member files are memory-mapped (on first access, keeping at most max_mappings live), and getbuffer returns zero-copy slices - which suits small random reads.
+  """
 
-  def __init__(self, *args):
+  def __init__(self, *args, lazy=False, max_open_files=DEFAULT_MAX_OPEN_FILES, sizes=None, use_mmap=False, max_mappings=DEFAULT_MAX_MAPPINGS):
+    """
+
+    :param args: File names, or iterables of file names.
+    :param lazy: Open member files on first access, keeping at most max_open_files open.
+    :param sizes: Sizes of the files, if already known (say, from a manifest saved with save_manifest) - saves an os.stat per file.
+    :param use_mmap: Read through memory maps rather than file handles. Member files are then never held open.
+    :param max_mappings: Bound on live memory maps; None means no bound.
+    """
     filenames = []
     for arg in args:
       if isinstance(arg, str):
@@ -13,21 +44,91 @@ class MultiFileReader(io.BufferedIOBase):
       else:
         for name in arg:
           filenames.append(name)
-    files = []
-    ranges = []
+    if sizes is None:
+      sizes = [os.stat(name).st_size for name in filenames]
+    elif len(sizes) != len(filenames):
+      raise ValueError("Got %d sizes for %d files" % (len(sizes), len(filenames)))
+    starts = []
     offset = 0
-    for name in filenames:
-      size = os.stat(name).st_size
-      ranges.append(range(offset, offset+size))
-      files.append(fopen(name, 'rb'))
+    for size in sizes:
+      starts.append(offset)
       offset += size
     self.size = offset
-    self._ranges = ranges
-    self._files = files
-    self._fcount = len(self._files)
+    self._filenames = filenames
+    self._starts = starts
+    self._sizes = list(sizes)
+    self._lazy = lazy
+    self._max_open_files = max_open_files
+    # Open files by index, least recently used first.
+    self._files = OrderedDict()
+    self._use_mmap = use_mmap
+    self._max_mappings = max_mappings
+    # Views of memory maps by index, least recently used first.
+    self._mappings = OrderedDict()
+    # Where each underlying file is positioned, to skip redundant seeks.
+    self._positions = [0] * len(filenames)
+    self._fcount = len(filenames)
+    self._closed = False
+    if not lazy and not use_mmap:
+      for file_index in range(self._fcount):
+        self._get_file(file_index)
     self._offset = -1
     self.seek(0)
 
+  @classmethod
+  def from_manifest(cls, manifest_path, **kwargs):
+    """
+    Make a reader over the files listed in a manifest saved by save_manifest, without statting them.
+    """
+    with fopen(manifest_path, 'r', encoding="utf-8") as manifest_file:
+      manifest = json.load(manifest_file)
+    return cls([name for (name, _) in manifest["files"]], sizes=[size for (_, size) in manifest["files"]], **kwargs)
+
+  def save_manifest(self, manifest_path):
+    """
+    Save the member file names and sizes, for use with from_manifest.
+    """
+    with fopen(manifest_path, 'w', encoding="utf-8") as manifest_file:
+      json.dump({"files": list(zip(self._filenames, self._sizes))}, manifest_file, ensure_ascii=False)
+
+  def _get_file(self, file_index):
+    f = self._files.get(file_index)
+    if f is not None:
+      self._files.move_to_end(file_index)
+      return f
+    f = fopen(self._filenames[file_index], 'rb')
+    self._positions[file_index] = 0
+    self._files[file_index] = f
+    if self._lazy and len(self._files) > self._max_open_files:
+      (_, evicted) = self._files.popitem(last=False)
+      evicted.close()
+    return f
+
+  def _get_mapping(self, file_index):
+    """
+    :return: A memoryview of the memory map of the file.
+    """
+    mapped = self._mappings.get(file_index)
+    if mapped is not None:
+      self._mappings.move_to_end(file_index)
+      return mapped
+    with fopen(self._filenames[file_index], 'rb') as f:
+      mapped = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    self._mappings[file_index] = mapped
+    if self._max_mappings is not None and len(self._mappings) > self._max_mappings:
+      (_, evicted) = self._mappings.popitem(last=False)
+      self._close_mapping(evicted)
+    return mapped
+
+  def _close_mapping(self, mapped):
+    mapping = mapped.obj
+    mapped.release()
+    try:
+      mapping.close()
+    except BufferError:
+      # Slices handed out by getbuffer are still alive; the map goes away with the last of them.
+      pass
+
   def  __enter__(self):
     return self
 
@@ -36,13 +137,17 @@ class MultiFileReader(io.BufferedIOBase):
     return False
 
   def close(self):
-    for f in self._files:
+    for f in self._files.values():
       f.close()
     self._files.clear()
-    self._ranges.clear()
+    for mapping in self._mappings.values():
+      self._close_mapping(mapping)
+    self._mappings.clear()
+    self._closed = True
 
+  @property
   def closed(self):
-    return len(self._ranges) == 0
+    return self._closed
 
   def isatty(self):
     return False
@@ -70,32 +175,175 @@ class MultiFileReader(io.BufferedIOBase):
   def writable(self):
     return False
 
-  def read(self, n=-1):
-    file_index = -1
-    actual_offset = 0
-    for i, r in enumerate(self._ranges):
-      if self._offset in r:
-        file_index = i
-        actual_offset = self._offset - r.start
-        break
-    result = b''
-    if (n == -1 or n is None):
-      to_read = self.size
+  def _locate(self, offset):
+    """
+    :return: (index of the file holding offset, offset within that file)
+    """
+    # Empty files share their start with the next file; bisect_right skips past them.
+    file_index = bisect.bisect_right(self._starts, offset) - 1
+    return (file_index, offset - self._starts[file_index])
+
+  def _remaining(self):
+    return max(0, self.size - self._offset)
+
+  def _readinto_file(self, file_index, file_offset, view):
+    """
+    Read from a single member file into view, which must not extend past that file's end.
+    """
+    if self._use_mmap:
+      mapped = self._get_mapping(file_index)
+      count = max(0, min(len(view), len(mapped) - file_offset))
+      view[:count] = mapped[file_offset:file_offset + count]
     else:
-      to_read = n
-    while -1 < file_index < self._fcount:
-      f = self._files[file_index]
-      f.seek(actual_offset)
-      read = f.read(to_read)
-      read_count = len(read)
-      self._offset += read_count
-      result += read
-      to_read -= read_count
-      if to_read > 0:
-        file_index += 1
-        actual_offset = 0
-      else:
-        break
-    return result
+      f = self._get_file(file_index)
+      if self._positions[file_index] != file_offset:
+        f.seek(file_offset)
+      count = f.readinto(view) or 0
+      self._positions[file_index] = file_offset + count
+    if count < len(view):
+      # The file shrank since it was opened; continue with the next one.
+      self._offset = self._starts[file_index] + self._sizes[file_index]
+    else:
+      self._offset += count
+    return count
+
+  def readinto(self, b, single_file=False):
+    view = memoryview(b).cast('B')
+    to_read = min(len(view), self._remaining())
+    if to_read == 0 or self._offset < 0:
+      return 0
+    (file_index, file_offset) = self._locate(self._offset)
+    total = 0
+    while total < to_read and file_index < self._fcount:
+      count = min(to_read - total, self._sizes[file_index] - file_offset)
+      if count > 0:
+        total += self._readinto_file(file_index, file_offset, view[total:total + count])
+        if single_file:
+          break
+      file_index += 1
+      file_offset = 0
+    return total
 
+  def readinto1(self, b):
+    return self.readinto(b, single_file=True)
 
+  def read(self, n=-1):
+    if n is None or n < 0:
+      n = self._remaining()
+    buffer = bytearray(min(n, self._remaining()))
+    count = self.readinto(buffer)
+    del buffer[count:]
+    return bytes(buffer)
+
+  def read1(self, n=-1):
+    if self._offset < 0 or self._remaining() == 0:
+      return b''
+    if n is None or n < 0:
+      (file_index, file_offset) = self._locate(self._offset)
+      n = self._sizes[file_index] - file_offset
+    buffer = bytearray(min(n, self._remaining()))
+    count = self.readinto1(buffer)
+    del buffer[count:]
+    return bytes(buffer)
+
+  def peek(self, n=0):
+    """
+    Return bytes from the current position, without advancing it - at least one byte unless at EOF, at most up to the end of the current file.
+    """
+    offset = self._offset
+    try:
+      return self.read1(max(n, io.DEFAULT_BUFFER_SIZE))
+    finally:
+      self._offset = offset
+
+  def getbuffer(self, offset, length):
+    """
+    Get length bytes at offset (fewer at the end of the stream), without moving the stream position.
+
+    In mmap mode, a span within a single member file is returned as a zero-copy slice of its memory map. Spans crossing files (and all spans in the other modes) are copied once into a new buffer.
+
+    :return: A read-only memoryview.
+    """
+    length = max(0, min(length, self.size - offset))
+    if length == 0:
+      return memoryview(b'')
+    (file_index, file_offset) = self._locate(offset)
+    if self._use_mmap and file_offset + length <= self._sizes[file_index]:
+      return self._get_mapping(file_index)[file_offset:file_offset + length]
+    buffer = bytearray(length)
+    stream_offset = self._offset
+    try:
+      self._offset = offset
+      count = self.readinto(buffer)
+    finally:
+      self._offset = stream_offset
+    del buffer[count:]
+    return memoryview(buffer).toreadonly()
+
+  def split_ranges(self, range_size=DEFAULT_RANGE_SIZE, delimiter=b"\n"):
+    """
+    Split the stream into byte ranges of about range_size, each ending just after a delimiter or at the end of a member file. So no record spans two ranges, and no range spans two files.
+
+    :return: A list of (file name, stream offset of the file's start, range start, range end) tuples.
+    """
+    ranges = []
+    for (file_index, name) in enumerate(self._filenames):
+      file_start = self._starts[file_index]
+      file_end = file_start + self._sizes[file_index]
+      start = file_start
+      while start < file_end:
+        end = min(start + range_size, file_end)
+        # Extend the range to just past the next delimiter.
+        while end < file_end:
+          block = self.getbuffer(end, min(range_size, file_end - end))
+          index = bytes(block).find(delimiter)
+          if index >= 0:
+            end = min(end + index + len(delimiter), file_end)
+            break
+          # Keep any partial delimiter at the block's end in the next search.
+          end += max(1, len(block) - len(delimiter) + 1)
+        end = min(end, file_end)
+        ranges.append((name, file_start, start, end))
+        start = end
+    return ranges
+
+
+def _map_range(fn, delimiter, file_range):
+  (name, file_start, start, end) = file_range
+  with fopen(name, 'rb') as f:
+    f.seek(start - file_start)
+    data = f.read(end - start)
+  records = data.split(delimiter)
+  if data.endswith(delimiter):
+    records.pop()
+  results = []
+  offset = start
+  for record in records:
+    result = fn(record)
+    if result is not None:
+      results.append((name, offset, result))
+    offset += len(record) + len(delimiter)
+  return results
+
+
+def map_records(reader, fn, range_size=DEFAULT_RANGE_SIZE, delimiter=b"\n", workers=None, ordered=True):
+  """
+  Apply fn to every record (say, line) of a MultiFileReader's stream, in a pool of worker processes.
+
+  Member file boundaries also end records. The stream is split with reader.split_ranges, and each worker reads its ranges straight from the member files.
+
+  :param fn: A picklable (module level) function taking a record's bytes, without the delimiter. None results are dropped - handy for grepping.
+  :param workers: Number of worker processes. None means os.cpu_count().
+  :param ordered: Yield results in stream order, rather than as ranges complete.
+  :return: A generator of (source file name, stream offset of the record, result) tuples.
+  """
+  ranges = reader.split_ranges(range_size=range_size, delimiter=delimiter)
+  map_range = functools.partial(_map_range, fn, delimiter)
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    if ordered:
+      for results in executor.map(map_range, ranges):
+        yield from results
+    else:
+      futures = [executor.submit(map_range, file_range) for file_range in ranges]
+      for future in as_completed(futures):
+        yield from future.result()
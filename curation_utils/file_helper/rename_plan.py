@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+
+
+class RenamePlan(object):
+  """
+  A list of renames, each of a single path component (src and dest share a parent directory).
+
+  A plan is applied bottom-up - deeper paths first - so that every src is still valid when its turn comes. Undoing it applies the inverse renames top-down. So a saved plan doubles as a dry-run report and as an undo log.
+  """
+
+  def __init__(self, renames=None):
+    """
+
+    :param renames: An iterable of (src, dest) pairs.
+    """
+    self.renames = [(str(src), str(dest)) for (src, dest) in (renames or [])]
+
+  def __len__(self):
+    return len(self.renames)
+
+  def __iter__(self):
+    return iter(self.renames)
+
+  def add(self, src, dest):
+    self.renames.append((str(src), str(dest)))
+
+  def to_json(self):
+    return json.dumps([{"src": src, "dest": dest} for (src, dest) in self.renames], ensure_ascii=False, indent=1)
+
+  @classmethod
+  def from_json(cls, json_str):
+    return cls(renames=[(item["src"], item["dest"]) for item in json.loads(json_str)])
+
+  def save(self, plan_path):
+    with open(plan_path, 'w', encoding="utf-8") as file:
+      file.write(self.to_json())
+
+  @classmethod
+  def load(cls, plan_path):
+    with open(plan_path, 'r', encoding="utf-8") as file:
+      return cls.from_json(file.read())
+
+  def _levels(self, renames, bottom_up):
+    depth = lambda rename: rename[0].count(os.sep)
+    renames = sorted(renames, key=depth, reverse=bottom_up)
+    return [list(level) for (_, level) in groupby(renames, key=depth)]
+
+  def _run(self, renames, bottom_up, dry_run, workers):
+    def rename(src_dest):
+      (src, dest) = src_dest
+      logging.info("Changing '%s' to '%s'", src, dest)
+      if dry_run:
+        return None
+      try:
+        os.rename(src, dest)
+        return None
+      except OSError as e:
+        logging.error("Could not rename '%s' to '%s': %s", src, dest, e)
+        return (src, dest, repr(e))
+
+    failures = []
+    # Renames at the same depth touch disjoint paths, so each level can be done concurrently.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      for level in self._levels(renames=renames, bottom_up=bottom_up):
+        failures.extend(failure for failure in executor.map(rename, level) if failure is not None)
+    logging.info("Renamed %d paths, %d failures", len(renames) - len(failures), len(failures))
+    return {"renamed": len(renames) - len(failures), "failed": failures}
+
+  def apply(self, dry_run=False, workers=1):
+    """
+    :param workers: Number of threads renaming entries at the same depth concurrently.
+    :return: A dict with the number of paths renamed and a list of (src, dest, error) failures.
+    """
+    return self._run(renames=self.renames, bottom_up=True, dry_run=dry_run, workers=workers)
+
+  def undo(self, dry_run=False, workers=1):
+    """
+    Restore the names changed by apply.
+    """
+    return self._run(renames=[(dest, src) for (src, dest) in self.renames], bottom_up=False, dry_run=dry_run, workers=workers)
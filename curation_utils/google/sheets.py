@@ -84,12 +84,17 @@ class FileUrlSheet(IndexSheet):
         file_name = re.sub("[^a-zA-Z0-9]+", "-", file_name)
         return file_name
 
-    def download_all(self, destination_dir, skip_existing=True):
-        import wget
+    def download_all(self, destination_dir, skip_existing=True, workers=8):
+        """
+        Download all files concurrently.
+
+        :return: The report of DownloadManager.download_all.
+        """
+        from curation_utils.file_helper.download_manager import DownloadManager
         os.makedirs(destination_dir, exist_ok=True)
+        downloads = []
         for url in self._df.index:
             extension = os.path.splitext(url)[1]
             out_file = os.path.join(destination_dir, "%s%s" % (self.get_file_name(url=url), extension))
-            if not skip_existing or not os.path.exists(out_file):
-                logging.info("Getting %s as %s", url, out_file)
-                wget.download(url=url, out=out_file)
\ No newline at end of file
+            downloads.append({"url": url, "path": out_file})
+        return DownloadManager(workers=workers).download_all(downloads, skip_existing=skip_existing)
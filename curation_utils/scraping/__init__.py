@@ -1,8 +1,13 @@
 from urllib.parse import urlparse, urljoin
 
+import asyncio
 import codecs
+import collections
+import functools
+import importlib.util
 import logging
 import random
+import threading
 import time
 from functools import lru_cache
 
@@ -14,7 +19,7 @@ from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_excep
 import regex
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException, \
   ElementNotInteractableException, ElementClickInterceptedException, JavascriptException, TimeoutException, \
   UnexpectedAlertPresentException, NoAlertPresentException
@@ -174,12 +179,33 @@ def clean_url(url):
   return url
 
 
+def _get_retry_predicate(retry_on_404=False):
+  """
+  :return: A predicate on a response's status code, telling whether the request deserves a retry. 403 and 503 (blocked, down) are not retried; 404 only if retry_on_404.
+  """
+  base_predicate = lambda status_code: 400 <= status_code < 523 and status_code not in [403, 503]
+  if retry_on_404:
+    return base_predicate
+  else:
+    return lambda status_code: base_predicate(status_code) and status_code not in [404]
+
+
 def build_get_url_backoffed(retry_on_404=False):
-  def base_get_url(url, method=httpx.get, timeout=30.0):
+  """
+
+  :return: A function get_url(url, method=httpx.get, timeout=30.0, headers=None) which retries on connection errors and on retriable status codes. method may also be the get/post method of an httpx.Client - which has its own verify setting. headers are added to a randomly chosen set of browser headers.
+  """
+  def base_get_url(url, method=httpx.get, timeout=30.0, headers=None):
+    kwargs = {}
+    if not isinstance(getattr(method, "__self__", None), httpx.Client):
+      kwargs["verify"] = False
+    request_headers = random.choice(header_choices)
+    if headers:
+      request_headers = dict(request_headers, **headers)
     return method(url=url,
-                  headers=random.choice(header_choices),
+                  headers=request_headers,
                   follow_redirects=True,
-                  timeout=timeout, verify=False)
+                  timeout=timeout, **kwargs)
   # Apply tenacity retry for connection errors
   fn = retry(wait=wait_exponential(multiplier=1, min=4, max=60),
              stop=stop_after_attempt(5),
@@ -192,24 +218,171 @@ def build_get_url_backoffed(retry_on_404=False):
                             factor=2, max_value=300, max_tries=5)(fn)
 
   # Predicate-based backoff
-  base_predicate = lambda result: 400 <= result.status_code < 523 and result.status_code not in [403, 503]
-  if retry_on_404:
-    predicate = base_predicate
-  else:
-    predicate = lambda result: base_predicate(result) and result.status_code not in [404]
-
+  status_predicate = _get_retry_predicate(retry_on_404=retry_on_404)
   fn = backoff.on_predicate(wait_gen=backoff.expo,
-                            predicate=predicate,
+                            predicate=lambda result: status_predicate(result.status_code),
                             max_time=6000,
                             factor=2, max_value=300, max_tries=5)(fn)
 
   return fn
 
 
+# The decorator stack is built once per retry policy, rather than per call.
+_get_url_backoffed_fns = {retry_on_404: build_get_url_backoffed(retry_on_404=retry_on_404) for retry_on_404 in [False, True]}
+
+
+def get_url_backoffed(url, method=httpx.get, timeout=30.0, retry_on_404=False, headers=None):
+  get_url = _get_url_backoffed_fns[bool(retry_on_404)]
+  return get_url(url=url, method=method, timeout=timeout, headers=headers)
+
+
+class Scraper(object):
+  """
+  A long-lived HTTP client for crawls. Connections are pooled and kept alive across requests (over HTTP/2 if the h2 package is installed), so that fetching many pages from one host does not pay for a connection and TLS handshake per page.
+
+  Usage:
+    with Scraper() as scraper:
+      (soup, _) = get_soup(url, scraper=scraper)
+
+  With a ResponseCache, GET responses are served from (and stored into) it.
+  """
 
-def get_url_backoffed(url, method=httpx.get, timeout=30.0, retry_on_404=False):
-  get_url = build_get_url_backoffed(retry_on_404=retry_on_404) 
-  return get_url(url=url, method=method, timeout=timeout)
+  def __init__(self, max_connections=100, max_connections_per_host=6, http2=None, timeout=30.0, verify=False, cache=None):
+    """
+
+    :param max_connections: Bound on connections across all hosts.
+    :param max_connections_per_host: Bound on concurrent requests to any single host.
+    :param http2: Whether to use HTTP/2. None means: if the h2 package is installed.
+    :param cache: A response_cache.ResponseCache.
+    """
+    if http2 is None:
+      http2 = importlib.util.find_spec("h2") is not None
+    self.timeout = timeout
+    self.cache = cache
+    self.client = httpx.Client(http2=http2, verify=verify, follow_redirects=True, timeout=timeout,
+                               limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+    self.max_connections_per_host = max_connections_per_host
+    self._host_semaphores = {}
+    self._host_semaphores_lock = threading.Lock()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+    return False
+
+  def close(self):
+    self.client.close()
+
+  def _get_host_semaphore(self, url):
+    host = urlparse(url).netloc
+    with self._host_semaphores_lock:
+      semaphore = self._host_semaphores.get(host)
+      if semaphore is None:
+        semaphore = threading.BoundedSemaphore(self.max_connections_per_host)
+        self._host_semaphores[host] = semaphore
+    return semaphore
+
+  def request(self, url, method="GET", timeout=None, retry_on_404=False):
+    """
+    Fetch url, with the retries of get_url_backoffed. Safe to call from many threads.
+    """
+    get_url_backoffed = _get_url_backoffed_fns[bool(retry_on_404)]
+    def get_url(url, headers=None):
+      with self._get_host_semaphore(url):
+        return get_url_backoffed(url=url, method=getattr(self.client, method.lower()), timeout=timeout or self.timeout, headers=headers)
+    if self.cache is not None and method.upper() == "GET":
+      return self.cache.fetch(url=url, get_url=get_url)
+    return get_url(url=url)
+
+  def get(self, url, timeout=None, retry_on_404=False):
+    return self.request(url=url, method="GET", timeout=timeout, retry_on_404=retry_on_404)
+
+  def post(self, url, timeout=None, retry_on_404=False):
+    return self.request(url=url, method="POST", timeout=timeout, retry_on_404=retry_on_404)
+
+
+def _build_fetch_backoffed_async(retry_on_404=False, wait_turn=None):
+  """
+  Like build_get_url_backoffed, for coroutines fetching with an httpx.AsyncClient.
+
+  :param wait_turn: A coroutine function taking the url, awaited before every attempt (retries included) - to rate limit requests per host.
+  """
+  async def base_fetch(client, url, timeout=30.0):
+    if wait_turn is not None:
+      await wait_turn(url)
+    return await client.get(url=url, headers=random.choice(header_choices), timeout=timeout)
+  fn = retry(wait=wait_exponential(multiplier=1, min=4, max=60),
+             stop=stop_after_attempt(5),
+             retry=retry_if_exception_type(httpx.ConnectError))(base_fetch)
+  fn = backoff.on_exception(wait_gen=backoff.expo,
+                            exception=(ConnectError, RequestError),
+                            max_time=6000,
+                            factor=2, max_value=300, max_tries=5)(fn)
+  status_predicate = _get_retry_predicate(retry_on_404=retry_on_404)
+  fn = backoff.on_predicate(wait_gen=backoff.expo,
+                            predicate=lambda result: status_predicate(result.status_code),
+                            max_time=6000,
+                            factor=2, max_value=300, max_tries=5)(fn)
+  return fn
+
+
+async def fetch_many(urls, per_host_concurrency=2, min_delay=1.0, jitter=0.0, retry_on_404=False, max_connections=100, timeout=30.0):
+  """
+  Fetch many urls concurrently - in parallel across hosts, while being polite to each host.
+
+  Each host gets per_host_concurrency workers taking its urls in order, and successive requests to a host - retries included - start at least min_delay (plus up to jitter) seconds apart. Retries are as in get_url_backoffed.
+
+  Usage:
+    async for (url, result) in fetch_many(urls):
+      ...
+
+  :return: An async generator of (url, result) pairs, in order of completion. result is an httpx.Response, or the exception raised once retries were exhausted.
+  """
+  loop = asyncio.get_running_loop()
+  host_states = {}
+
+  async def wait_turn(url):
+    host_state = host_states[urlparse(url).netloc]
+    async with host_state["lock"]:
+      delay = host_state["next_start"] - loop.time()
+      if delay > 0:
+        await asyncio.sleep(delay)
+      host_state["next_start"] = loop.time() + min_delay + random.uniform(0, jitter)
+
+  fetch = _build_fetch_backoffed_async(retry_on_404=retry_on_404, wait_turn=wait_turn)
+  host_to_urls = {}
+  url_count = 0
+  for url in urls:
+    url_count += 1
+    host_to_urls.setdefault(urlparse(url).netloc, collections.deque()).append(url)
+  results = asyncio.Queue()
+
+  async def host_worker(client, host_urls):
+    while host_urls:
+      url = host_urls.popleft()
+      try:
+        result = await fetch(client, url=url, timeout=timeout)
+      except Exception as e:
+        logging.warning("Failed to fetch %s: %s", url, e)
+        result = e
+      await results.put((url, result))
+
+  limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+  async with httpx.AsyncClient(verify=False, follow_redirects=True, limits=limits) as client:
+    workers = []
+    for (host, host_urls) in host_to_urls.items():
+      host_states[host] = {"lock": asyncio.Lock(), "next_start": 0}
+      for _ in range(min(per_host_concurrency, len(host_urls))):
+        workers.append(asyncio.create_task(host_worker(client, host_urls)))
+    try:
+      for _ in range(url_count):
+        yield await results.get()
+    finally:
+      for worker in workers:
+        worker.cancel()
+      await asyncio.gather(*workers, return_exceptions=True)
 
 
 def get_url_aws(url, config_aws=None):
@@ -231,13 +404,92 @@ def get_url_aws(url, config_aws=None):
   gateway.shutdown()
 
 
-@lru_cache(maxsize=2)
-def get_soup(url, config_aws=None, features="html.parser", retry_on_404=False):
+# The fastest installed parser for BeautifulSoup. lxml is several times faster than the pure-Python html.parser.
+DEFAULT_PARSER = "lxml" if importlib.util.find_spec("lxml") is not None else "html.parser"
+
+_simple_selector = regex.compile(r"^([a-zA-Z][\w-]*)?(?:([.#])([\w-]+))?$")
+
+
+def get_soup_strainer(selector):
+  """
+  Convert a simple CSS selector to a SoupStrainer, for partial parsing.
+
+  :param selector: A tag name, class or id selector (div, .content, #main, div.content, div#main), or a comma-separated list of tag names (h1, h2, p).
+  """
+  parts = [part.strip() for part in selector.split(",")]
+  matches = [_simple_selector.match(part) for part in parts]
+  if any(match is None or match.group(0) == "" for match in matches):
+    raise ValueError("Unsupported selector: %s" % selector)
+  if len(parts) > 1:
+    if any(match.group(2) for match in matches):
+      raise ValueError("Only tag names may be listed in a selector: %s" % selector)
+    return SoupStrainer(parts)
+  (name, kind, value) = matches[0].groups()
+  attrs = {}
+  if kind == "#":
+    attrs["id"] = value
+  elif kind == ".":
+    # Attribute values are matched as whole strings while parsing, so match one class among several.
+    attrs["class"] = regex.compile(r"(?:^|\s)%s(?:\s|$)" % regex.escape(value))
+  return SoupStrainer(name, attrs=attrs)
+
+
+def make_soup(content, features=None, parse_only=None):
+  """
+
+  :param features: The parser. None means DEFAULT_PARSER.
+  :param parse_only: A SoupStrainer or a simple CSS selector (see get_soup_strainer). Only matching elements (with their descendants) are built, which is much faster than parsing the whole page.
+  """
+  if isinstance(parse_only, str):
+    parse_only = get_soup_strainer(parse_only)
+  return BeautifulSoup(content, features=features or DEFAULT_PARSER, parse_only=parse_only)
+
+
+def extract_text_and_links(content, base_url=None):
+  """
+  Extract just the text and link targets of a page, without building a soup - using selectolax or lxml if installed.
+
+  :return: (text, list of hrefs - resolved against base_url if given)
+  """
+  try:
+    from selectolax.parser import HTMLParser
+    tree = HTMLParser(content)
+    root = tree.body or tree.root
+    text = root.text(separator="\n") if root is not None else ""
+    links = [node.attributes.get("href") for node in tree.css("a[href]")]
+  except ImportError:
+    try:
+      import lxml.html
+      tree = lxml.html.document_fromstring(content)
+      text = "\n".join(tree.itertext())
+      links = tree.xpath("//a/@href")
+    except ImportError:
+      soup = BeautifulSoup(content, features="html.parser")
+      text = soup.get_text(separator="\n")
+      links = [anchor["href"] for anchor in soup.find_all("a", href=True)]
+  if base_url is not None:
+    links = [urljoin(base_url, link) for link in links]
+  return (text, links)
+
+
+def get_soup(url, config_aws=None, features=None, retry_on_404=False, scraper=None, cache=None, parse_only=None):
   """
   
   :param url: Examples: https://a:b@c.com/ https://xyz.com 
+  :param scraper: A Scraper whose pooled connections (and response cache, if any) to use.
+  :param cache: A response_cache.ResponseCache, for use without a scraper.
+  :param features: The parser. None means DEFAULT_PARSER.
+  :param parse_only: See make_soup.
   :return: 
   """
+  # lru_cache needs hashable arguments.
+  if config_aws is not None:
+    config_aws = tuple(config_aws)
+  return _get_soup(url=url, config_aws=config_aws, features=features, retry_on_404=retry_on_404, scraper=scraper, cache=cache, parse_only=parse_only)
+
+
+@lru_cache(maxsize=2)
+def _get_soup(url, config_aws, features, retry_on_404, scraper, cache, parse_only):
   url = url.replace("file://", "")
   url = clean_url(url)
   if url.startswith("/"):
@@ -248,6 +500,10 @@ def get_soup(url, config_aws=None, features="html.parser", retry_on_404=False):
   else:
     if config_aws is not None:
       result = get_url_aws(url=url, config_aws=config_aws)
+    elif scraper is not None:
+      result = scraper.get(url=url, retry_on_404=retry_on_404)
+    elif cache is not None:
+      result = cache.fetch(url=url, get_url=functools.partial(get_url_backoffed, retry_on_404=retry_on_404))
     else:
       result = get_url_backoffed(url=url, retry_on_404=retry_on_404)
 
@@ -256,14 +512,17 @@ def get_soup(url, config_aws=None, features="html.parser", retry_on_404=False):
 
     content = result.text
 
-  soup = BeautifulSoup(content, features=features)
+  soup = make_soup(content, features=features, parse_only=parse_only)
   return (soup, result)
 
 
-def get_post_soup(url, timeout=30.0, retry_on_404=False):
-  result = get_url_backoffed(url=url, method=httpx.post, timeout=timeout, retry_on_404=retry_on_404)
+def get_post_soup(url, timeout=30.0, retry_on_404=False, scraper=None, features=None, parse_only=None):
+  if scraper is not None:
+    result = scraper.post(url=url, timeout=timeout, retry_on_404=retry_on_404)
+  else:
+    result = get_url_backoffed(url=url, method=httpx.post, timeout=timeout, retry_on_404=retry_on_404)
   content = result.text
-  soup = BeautifulSoup(content, features="html.parser")
+  soup = make_soup(content, features=features, parse_only=parse_only)
   return soup
 
 
@@ -430,7 +689,7 @@ def scroll_with_selenium(
   logging.info(f"Scrolled and stabilized {element_css} in {url}")
   return browser.page_source
 
-def scroll_and_get_soup(*args, **kwargs):
+def scroll_and_get_soup(*args, features=None, parse_only=None, **kwargs):
   content = scroll_with_selenium(*args, **kwargs)
-  soup = BeautifulSoup(content, features="html.parser")
+  soup = make_soup(content, features=features, parse_only=parse_only)
   return soup
@@ -0,0 +1,171 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import httpx
+
+# Statuses which may be reused without revalidation concerns (as in RFC 9111's "heuristically cacheable" list, less 206 and 501).
+CACHEABLE_STATUSES = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414}
+# Headers describing the transfer rather than the (decoded) body we store.
+_DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive"}
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+  """
+  Normalize url for use as a cache key: lower-case scheme and host, no default port, no fragment, sorted query parameters.
+  """
+  parts = urlsplit(url.strip())
+  scheme = parts.scheme.lower()
+  netloc = (parts.hostname or "").lower()
+  if parts.port is not None and parts.port != _DEFAULT_PORTS.get(scheme):
+    netloc = "%s:%d" % (netloc, parts.port)
+  if parts.username is not None:
+    userinfo = parts.username + (":" + parts.password if parts.password is not None else "")
+    netloc = userinfo + "@" + netloc
+  query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+  return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+class ResponseCache(object):
+  """
+  An on-disk (SQLite) cache of HTTP responses, keyed on normalized url and method.
+
+  Stored responses are revalidated with conditional requests (ETag / Last-Modified), so that a re-run of a crawl downloads only new or changed pages. The least recently used entries are evicted when the stored bodies exceed max_size bytes.
+
+  Usage:
+    cache = ResponseCache("crawl_cache.sqlite")
+    response = cache.fetch(url, get_url=scraping.get_url_backoffed)
+  """
+
+  def __init__(self, db_path, max_size=1073741824, max_age=None, offline=False):
+    """
+
+    :param max_size: Bound on the total size of the (compressed) stored bodies, in bytes.
+    :param max_age: Seconds for which a stored response is served without revalidation. None means always revalidate.
+    :param offline: Serve only from the cache; misses get a synthetic 504 response.
+    """
+    self.db_path = str(db_path)
+    self.max_size = max_size
+    self.max_age = max_age
+    self.offline = offline
+    self._lock = threading.Lock()
+    self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+    with self._connection:
+      self._connection.execute("PRAGMA journal_mode=WAL")
+      self._connection.execute(
+        "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, status INTEGER, headers TEXT, body BLOB, size INTEGER, stored_at REAL, accessed_at REAL)")
+      self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+    # The total size of the stored bodies - kept up to date by put and _evict, rather than summed on every put.
+    self._total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+    return False
+
+  def close(self):
+    with self._lock:
+      self._connection.close()
+
+  def __len__(self):
+    with self._lock:
+      return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+  def _key(self, url, method):
+    return "%s %s" % (method.upper(), normalize_url(url))
+
+  def get(self, url, method="GET"):
+    """
+    :return: The stored entry (a dict with url, status, headers, body and stored_at), or None.
+    """
+    key = self._key(url, method)
+    with self._lock:
+      row = self._connection.execute("SELECT url, status, headers, body, stored_at FROM responses WHERE key = ?", (key,)).fetchone()
+      if row is None:
+        return None
+      with self._connection:
+        self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+    (stored_url, status, headers, body, stored_at) = row
+    return {"url": stored_url, "status": status, "headers": json.loads(headers), "body": zlib.decompress(body), "stored_at": stored_at}
+
+  def put(self, url, response, method="GET"):
+    """
+    Store response, if its status is cacheable.
+    """
+    if response.status_code not in CACHEABLE_STATUSES:
+      return
+    headers = [(name, value) for (name, value) in response.headers.multi_items() if name.lower() not in _DROPPED_HEADERS]
+    body = zlib.compress(response.content)
+    now = time.time()
+    key = self._key(url, method)
+    with self._lock:
+      with self._connection:
+        row = self._connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self._connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (key, str(response.url), response.status_code, json.dumps(headers), body, len(body), now, now))
+      self._total_size += len(body) - (row[0] if row is not None else 0)
+      self._evict()
+
+  def _touch(self, url, method):
+    with self._lock:
+      with self._connection:
+        now = time.time()
+        self._connection.execute("UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?", (now, now, self._key(url, method)))
+
+  def _evict(self):
+    if self._total_size <= self.max_size:
+      return
+    excess = self._total_size - self.max_size
+    keys = []
+    evicted_size = 0
+    for (key, size) in self._connection.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+      keys.append((key,))
+      evicted_size += size
+      if evicted_size >= excess:
+        break
+    with self._connection:
+      self._connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+    self._total_size -= evicted_size
+    logging.debug("Evicted %d responses from %s", len(keys), self.db_path)
+
+  def is_fresh(self, entry):
+    return self.max_age is not None and time.time() - entry["stored_at"] < self.max_age
+
+  def to_response(self, entry, method="GET"):
+    return httpx.Response(status_code=entry["status"], headers=entry["headers"], content=entry["body"],
+                          request=httpx.Request(method, entry["url"]), extensions={"from_cache": True})
+
+  def fetch(self, url, get_url, method="GET"):
+    """
+    Get the response for url - from the cache if it is fresh or still valid, else via get_url.
+
+    :param get_url: A function taking url and headers (to which the conditional request headers are added), like get_url_backoffed.
+    :return: An httpx.Response. Responses served from the cache have response.extensions["from_cache"] set.
+    """
+    entry = self.get(url, method=method)
+    if entry is not None and (self.offline or self.is_fresh(entry)):
+      return self.to_response(entry, method=method)
+    if self.offline:
+      logging.info("Not in cache (offline): %s", url)
+      return httpx.Response(status_code=504, request=httpx.Request(method, url), extensions={"from_cache": True})
+    headers = {}
+    if entry is not None:
+      entry_headers = httpx.Headers(entry["headers"])
+      if "etag" in entry_headers:
+        headers["If-None-Match"] = entry_headers["etag"]
+      if "last-modified" in entry_headers:
+        headers["If-Modified-Since"] = entry_headers["last-modified"]
+    response = get_url(url=url, headers=headers)
+    if response.status_code == 304 and entry is not None:
+      logging.debug("Not modified: %s", url)
+      self._touch(url, method=method)
+      return self.to_response(entry, method=method)
+    self.put(url, response, method=method)
+    return response
@@ -0,0 +1,293 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+import backoff
+import internetarchive
+import pytest
+import requests
+
+from curation_utils import archive_utility
+from curation_utils.file_helper import download_manager, manifest
+
+
+class FakeItem(object):
+    """Stands in for internetarchive.Item: files as in item metadata, and uploads recorded rather than made."""
+
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def __init__(self, identifier, files=(), failures=None):
+        self.identifier = identifier
+        self.files = list(files)
+        self.exists = bool(self.files)
+        self.uploads = []
+        self.item_metadata = {"metadata": {"identifier": identifier}, "files": self.files}
+        # Remote name to the number of failures before its upload succeeds.
+        self.failures = dict(failures or {})
+
+    def upload(self, files, metadata=None, **kwargs):
+        with FakeItem.lock:
+            FakeItem.active += 1
+            FakeItem.max_active = max(FakeItem.max_active, FakeItem.active)
+        time.sleep(0.01)
+        with FakeItem.lock:
+            FakeItem.active -= 1
+            for name in files:
+                if self.failures.get(name, 0) > 0:
+                    self.failures[name] -= 1
+                    raise requests.exceptions.HTTPError("503 for %s" % name)
+            if not self.exists:
+                assert len(self.uploads) == 0 and metadata is not None
+                self.exists = True
+            self.uploads.append(dict(files))
+        for (name, file_path) in files.items():
+            with open(file_path, "rb") as f:
+                content = f.read()
+            self.files = [x for x in self.files if x["name"] != name]
+            self.files.append({"name": name, "source": "original", "size": str(len(content)), "md5": hashlib.md5(content).hexdigest()})
+        return [SimpleNamespace(ok=True, status_code=200, raise_for_status=lambda: None) for _ in files]
+
+
+def _remote_file(name, content):
+    return {"name": name, "source": "original", "size": str(len(content)), "md5": hashlib.md5(content).hexdigest()}
+
+
+@pytest.fixture
+def fake_ia(monkeypatch):
+    items = {}
+    monkeypatch.setattr(archive_utility, "_sessions", {})
+    monkeypatch.setattr(archive_utility.internetarchive, "get_session", lambda **kwargs: SimpleNamespace(access_key="a", secret_key="s"))
+    monkeypatch.setattr(archive_utility.internetarchive, "get_item", lambda archive_id, **kwargs: items.setdefault(archive_id, FakeItem(archive_id)))
+    return items
+
+
+def test_update_with_files_syncs_changes(tmp_path, fake_ia):
+    for name in ["a.mp3", "b.mp3", "c.mp3"]:
+        (tmp_path / name).write_bytes(name.encode() * 100)
+    fake_ia["item"] = FakeItem("item", files=[_remote_file("a.mp3", b"a.mp3" * 100), _remote_file("b.mp3", b"old"), {"name": "item_meta.xml", "source": "original"}])
+    file_paths = sorted(str(path) for path in tmp_path.iterdir())
+    archive_item = archive_utility.ArchiveItem("item", repo_base=str(tmp_path))
+    # b.mp3 changed, c.mp3 is new.
+    assert sorted(archive_item.plan_sync(file_paths, checksum=False)) == ["c.mp3"]
+    assert sorted(archive_item.plan_sync(file_paths)) == ["b.mp3", "c.mp3"]
+    archive_item.update_with_files(file_paths)
+    assert sorted(name for upload in fake_ia["item"].uploads for name in upload) == ["b.mp3", "c.mp3"]
+    assert os.path.exists(str(tmp_path / archive_utility.SYNC_MANIFEST_NAME))
+
+    # archive.org rewriting an uploaded file does not cause reuploads.
+    fake_ia["item"].files = [dict(x, md5="0" * 32) if x["name"] == "c.mp3" else x for x in fake_ia["item"].files]
+    file_paths = sorted(str(path) for path in tmp_path.iterdir())
+    archive_item = archive_utility.ArchiveItem("item", repo_base=str(tmp_path))
+    (tmp_path / "a.mp3").write_bytes(b"changed")
+    fake_ia["item"].uploads = []
+    archive_item.update_with_files(file_paths)
+    assert fake_ia["item"].uploads == [{"a.mp3": str(tmp_path / "a.mp3")}]
+
+
+def test_first_sync_of_rewritten_item(tmp_path, fake_ia):
+    # An existing item, whose mp3s archive.org has rewritten since they were uploaded - and no manifest yet.
+    for name in ["a.mp3", "b.mp3", "c.mp3"]:
+        (tmp_path / name).write_bytes(name.encode() * 100)
+    local_mtime = os.path.getmtime(str(tmp_path / "a.mp3"))
+    fake_ia["item"] = FakeItem("item", files=[dict(_remote_file(name, b"rewritten " + name.encode()), mtime=str(int(local_mtime) + 100)) for name in ["a.mp3", "b.mp3"]] +
+                               [dict(_remote_file("c.mp3", b"old"), mtime=str(int(local_mtime) - 100))])
+    file_paths = sorted(str(path) for path in tmp_path.iterdir())
+    archive_item = archive_utility.ArchiveItem("item", repo_base=str(tmp_path))
+    # Only c.mp3 changed after the item's copy was made.
+    archive_item.update_with_files(file_paths)
+    assert fake_ia["item"].uploads == [{"c.mp3": str(tmp_path / "c.mp3")}]
+
+    # Later local changes are still uploaded.
+    (tmp_path / "a.mp3").write_bytes(b"changed")
+    os.utime(str(tmp_path / "a.mp3"), (local_mtime + 200, local_mtime + 200))
+    fake_ia["item"].uploads = []
+    archive_utility.ArchiveItem("item", repo_base=str(tmp_path)).update_with_files(file_paths)
+    assert fake_ia["item"].uploads == [{"a.mp3": str(tmp_path / "a.mp3")}]
+
+
+class _S3Handler(BaseHTTPRequestHandler):
+    """Stands in for the IA S3 endpoint: accepts PUTs, answering with the statuses queued in server.statuses (path -> list) first."""
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append((self.path, body))
+        statuses = self.server.statuses.get(self.path, [])
+        status = statuses.pop(0) if statuses else 200
+        content = b"" if status == 200 else b"<Error><Message>status %d</Message></Error>" % status
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class _LocalS3Adapter(requests.adapters.HTTPAdapter):
+    """Sends requests meant for s3.us.archive.org to the stub - after raising ConnectionResetError (as internetarchive does on socket resets) server.resets[path] times."""
+
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+
+    def send(self, request, **kwargs):
+        path = urlsplit(request.url).path
+        if self.server.resets.get(path, 0) > 0:
+            self.server.resets[path] -= 1
+            raise ConnectionResetError("Connection reset by peer")
+        request.url = self.server.base_url + path
+        return super().send(request, **kwargs)
+
+
+@pytest.fixture
+def s3_stub(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _S3Handler)
+    server.requests = []
+    server.statuses = {}
+    server.resets = {}
+    server.base_url = "http://127.0.0.1:%d" % server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    session = internetarchive.get_session(config={"s3": {"access": "a", "secret": "s"}})
+    session.mount("https://s3.us.archive.org/", _LocalS3Adapter(server))
+    monkeypatch.setattr(archive_utility, "_sessions", {})
+    monkeypatch.setattr(archive_utility.internetarchive, "get_session", lambda **kwargs: session)
+    monkeypatch.setattr(archive_utility.internetarchive, "get_item", lambda archive_id, **kwargs: internetarchive.Item(session, archive_id, item_metadata={"metadata": {"identifier": archive_id}, "files": [_remote_file("old.mp3", b"old")]}))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_upload_retries(tmp_path, s3_stub, monkeypatch):
+    monkeypatch.setattr(archive_utility, "_upload_backoffed", archive_utility._retry_uploads(backoff.constant, interval=0)(archive_utility._upload))
+    for name in ["ok.mp3", "overloaded.mp3", "reset.mp3", "forbidden.mp3", "down.mp3"]:
+        (tmp_path / name).write_bytes(name.encode())
+    s3_stub.statuses = {"/item/overloaded.mp3": [503, 503], "/item/forbidden.mp3": [403], "/item/down.mp3": [500] * archive_utility.UPLOAD_MAX_TRIES}
+    s3_stub.resets = {"/item/reset.mp3": 2}
+    result = archive_utility.ArchiveItem("item", repo_base=str(tmp_path)).update_with_files(sorted(str(path) for path in tmp_path.iterdir()))
+    assert sorted(result["uploaded"]) == ["ok.mp3", "overloaded.mp3", "reset.mp3"]
+    assert sorted(name for (name, _) in result["failed"]) == ["down.mp3", "forbidden.mp3"]
+    request_paths = [path for (path, _) in s3_stub.requests]
+    assert (request_paths.count("/item/overloaded.mp3"), request_paths.count("/item/reset.mp3")) == (3, 1)
+    # Client errors are not retried; server errors are, until UPLOAD_MAX_TRIES.
+    assert (request_paths.count("/item/forbidden.mp3"), request_paths.count("/item/down.mp3")) == (1, archive_utility.UPLOAD_MAX_TRIES)
+    assert ("/item/ok.mp3", b"ok.mp3") in s3_stub.requests
+
+
+def test_update_items(tmp_path, monkeypatch):
+    # Retry without waiting.
+    monkeypatch.setattr(archive_utility, "_upload_backoffed", archive_utility._retry_uploads(backoff.constant, interval=0)(archive_utility._upload))
+    items = {}
+
+    def item_factory(archive_id, repo_base, metadata):
+        if archive_id == "unreachable":
+            raise requests.exceptions.ConnectionError("Could not fetch metadata")
+        items[archive_id] = FakeItem(archive_id, failures={"0.mp3": 1, "1.mp3": archive_utility.UPLOAD_MAX_TRIES} if archive_id == "item1" else None)
+        return archive_utility.ArchiveItem(archive_id, repo_base=repo_base, metadata=metadata)
+
+    specs = []
+    for item_index in range(3):
+        dir_path = tmp_path / ("item%d" % item_index)
+        dir_path.mkdir()
+        for file_index in range(4):
+            (dir_path / ("%d.mp3" % file_index)).write_bytes(b"x" * file_index)
+        (dir_path / "notes.md").write_text("not matched")
+        specs.append({"item_id": "item%d" % item_index, "dir_path": str(dir_path), "file_patterns": ["*.mp3"], "metadata": {"title": "t"}})
+    specs.append({"item_id": "unreachable", "dir_path": str(tmp_path)})
+
+    monkeypatch.setattr(archive_utility, "_sessions", {})
+    monkeypatch.setattr(archive_utility.internetarchive, "get_item", lambda archive_id, **kwargs: items[archive_id])
+    monkeypatch.setattr(archive_utility.internetarchive, "get_session", lambda **kwargs: SimpleNamespace())
+    FakeItem.max_active = 0
+    summary = archive_utility.update_items(specs, max_workers=3, item_factory=item_factory)
+    assert 1 < FakeItem.max_active <= 3
+    for item_id in ["item0", "item2"]:
+        assert sorted(summary[item_id]["uploaded"]) == ["0.mp3", "1.mp3", "2.mp3", "3.mp3"]
+    # A file failing once is retried; one failing every time is reported.
+    assert sorted(summary["item1"]["uploaded"]) == ["0.mp3", "2.mp3", "3.mp3"]
+    assert [name for (name, _) in summary["item1"]["failed"]] == ["1.mp3"]
+    assert summary["unreachable"]["error"] is not None
+
+
+def test_lazy_item(tmp_path, fake_ia, monkeypatch):
+    session_configs = []
+    monkeypatch.setattr(archive_utility.internetarchive, "get_session", lambda config_file=None, **kwargs: session_configs.append(config_file) or SimpleNamespace(protocol="https:", host="archive.org"))
+    fake_ia["item"] = FakeItem("item", files=[_remote_file("a.mp3", b"a")])
+    archive_items = [archive_utility.ArchiveItem("item", config_file_path="ia.ini", repo_base="repo", metadata_cache_dir=str(tmp_path)) for _ in range(3)]
+    assert archive_items[0].get_remote_name("repo/x/a.mp3") == "x/a.mp3"
+    # Nothing fetched yet.
+    assert session_configs == [] and not os.path.exists(str(tmp_path / "item.json"))
+    assert archive_items[0].original_item_file_names == ["a.mp3"]
+    assert os.path.exists(str(tmp_path / "item.json"))
+    # The metadata cache serves other instances.
+    del fake_ia["item"]
+    assert archive_items[1].original_item_file_names == ["a.mp3"]
+    assert archive_items[1].archive_item.exists
+    assert session_configs == ["ia.ini"]
+    archive_items[1].forget_item()
+    assert not os.path.exists(str(tmp_path / "item.json"))
+
+
+def test_download_original_files(tmp_path, fake_ia, file_server, monkeypatch):
+    contents = {"a.mp3": b"a" * 100, "b.mp3": b"b" * 200}
+    file_server.files.update({"/item/" + name: content for (name, content) in contents.items()})
+    fake_ia["item"] = FakeItem("item", files=[_remote_file(name, content) for (name, content) in contents.items()])
+    fake_ia["item"].urls = SimpleNamespace(download=file_server.base_url + "/item")
+    destination_dir = str(tmp_path / "out")
+    report = archive_utility.ArchiveItem("item").download_original_files(destination_dir)
+    assert (report["downloaded"], report["skipped"]) == (2, 0)
+    assert os.path.exists(os.path.join(destination_dir, archive_utility.SYNC_MANIFEST_NAME))
+
+    # Present files are skipped without being hashed again.
+    for module in [manifest, download_manager]:
+        monkeypatch.setattr(module, "get_md5", lambda file_path: pytest.fail("Rehashed %s" % file_path))
+    report = archive_utility.ArchiveItem("item").download_original_files(destination_dir)
+    assert (report["downloaded"], report["skipped"]) == (0, 2)
+
+
+class FakeFile(object):
+    def __init__(self, item, name):
+        self.item = item
+        self.name = name
+
+    def delete(self, **kwargs):
+        if self.name.startswith("locked"):
+            raise requests.exceptions.HTTPError("403 for %s" % self.name)
+        self.item.deleted.append(self.name)
+        return SimpleNamespace(raise_for_status=lambda: None)
+
+
+def test_delete_files(fake_ia):
+    names = ["a.mp3", "a_old.mp3", "b_old.mp3", "mp3/c_old.mp3", "locked_old.mp3", "notes.txt", "item_meta.xml"]
+    fake_ia["item"] = FakeItem("item", files=[_remote_file(name, name.encode()) for name in names])
+    fake_ia["item"].deleted = []
+    fake_ia["item"].get_file = lambda name: FakeFile(fake_ia["item"], name)
+    archive_item = archive_utility.ArchiveItem("item")
+    assert archive_item.find_files(glob_patterns=["*_old.mp3"]) == ["a_old.mp3", "b_old.mp3", "mp3/c_old.mp3", "locked_old.mp3"]
+    assert archive_item.find_files(patterns=[r"[ab]\.mp3", "notes.*"], glob_patterns="item_*") == ["a.mp3", "notes.txt", "item_meta.xml"]
+
+    # Flags of compiled patterns are kept.
+    fake_ia["item"].files.append(_remote_file("A.MP3", b"A"))
+    archive_item = archive_utility.ArchiveItem("item")
+    assert archive_item.find_files(patterns=re.compile(r"a\.mp3", re.I)) == ["a.mp3", "A.MP3"]
+    assert archive_item.find_files(patterns=[re.compile(r".*\.mp3", re.I), "notes.*"], glob_patterns="item_*") == names + ["A.MP3"]
+    fake_ia["item"].files.pop()
+    archive_item = archive_utility.ArchiveItem("item")
+
+    assert archive_item.delete_matching(glob_pattern="*_old.mp3", dry_run=True) == {}
+    assert fake_ia["item"].deleted == []
+    results = archive_item.delete_matching(pattern=r".*_old\.mp3")
+    assert sorted(fake_ia["item"].deleted) == ["a_old.mp3", "b_old.mp3", "mp3/c_old.mp3"]
+    assert results["a_old.mp3"] is None and results["locked_old.mp3"] is not None
+
+    fake_ia["item"].deleted = []
+    archive_item.delete_unaccounted_for_files(["local/a.mp3", "c_old.mp3", "locked_old.mp3", "a_old.mp3", "b_old.mp3"])
+    # Remote names are compared with local basenames - so files under directories are deleted.
+    assert sorted(fake_ia["item"].deleted) == ["mp3/c_old.mp3", "notes.txt"]
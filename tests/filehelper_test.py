@@ -1,3 +1,9 @@
+import hashlib
+import io
+import os
+
+import pytest
+
 from curation_utils import file_helper
 
 
@@ -11,4 +17,269 @@ unicode_script = "devanagari"
 		विरचितया `दिव्यचकोरिकया' समलंकृता ।।
 			प्रथमविमर्शः ।।
     """
-    assert file_helper.clear_bad_chars(x) == x
\ No newline at end of file
+    assert file_helper.clear_bad_chars(x) == x
+    assert file_helper.clear_bad_chars_utf8(x.encode("utf-8")) == x.encode("utf-8")
+
+
+def test_clear_bad_chars_utf8():
+    x = "\ufeff+++\r\ntitle = \"चिद्\u200bगगनचन्द्रिका\"\r\n\u00a0\tकर्रोपपदाग्निहोत्रशास्त्रिणा ।।\r\rold mac\r\n"
+    assert file_helper.clear_bad_chars_utf8(x.encode("utf-8")) == _clear_bad_chars_in_text_mode(x.encode("utf-8"))
+    assert file_helper.clear_bad_chars_utf8(b"line1\rline2\r\nline3\n") == b"line1\nline2\nline3\n"
+
+
+def test_normalize_file_lone_cr(tmp_path):
+    data = "line1\rline2\r\nविमर्शः\u200b\r".encode("utf-8")
+    for streaming in [False, True]:
+        (tmp_path / "old_mac.txt").write_bytes(data)
+        report = file_helper.normalize_file(str(tmp_path / "old_mac.txt"), streaming=streaming)
+        assert report["encoding"] == "utf-8"
+        assert (tmp_path / "old_mac.txt").read_bytes() == _clear_bad_chars_in_text_mode(data) == "line1\nline2\nविमर्शः\n".encode("utf-8")
+
+def test_detect_encoding(tmp_path):
+    utf8_path = tmp_path / "utf8.txt"
+    utf8_path.write_text("चिद्गगनचन्द्रिका\n" * 1000, encoding="utf-8")
+    assert file_helper.detect_encoding(utf8_path) == "utf-8"
+    ascii_path = tmp_path / "ascii.txt"
+    ascii_path.write_text("prathamavimarshaH\n" * 1000, encoding="ascii")
+    assert file_helper.detect_encoding(ascii_path) == "ascii"
+    utf16_path = tmp_path / "utf16.txt"
+    utf16_path.write_text("चिद्गगनचन्द्रिका\n" * 1000, encoding="utf-16")
+    assert file_helper.detect_encoding(utf16_path, max_bytes=4096).lower().startswith("utf-16")
+
+
+def _clear_bad_chars_in_text_mode(data, encoding="utf-8"):
+    """What the original clear_bad_chars_in_file wrote: the text as read in text mode (with universal newlines), cleared of bad chars."""
+    return file_helper.clear_bad_chars(io.TextIOWrapper(io.BytesIO(data), encoding=encoding).read()).encode("utf-8")
+
+
+def test_normalize_tree(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "dirty.md").write_bytes("प्रथमः\r\nविमर्शः​\n".encode("utf-8"))
+    (tmp_path / "clean.md").write_text("प्रथमः\nविमर्शः\n", encoding="utf-8")
+    (tmp_path / "legacy.md").write_bytes(("Café naïve façade déjà vu\n" * 50).encode("cp1252"))
+    reports = file_helper.normalize_tree(tmp_path, pattern="**/*.md", workers=2)
+    assert [os.path.basename(report["path"]) for report in reports] == ["clean.md", "legacy.md", "dirty.md"]
+    assert all(report["error"] is None for report in reports)
+    assert [report["changed"] for report in reports] == [False, True, True]
+    assert (tmp_path / "sub" / "dirty.md").read_text(encoding="utf-8") == "प्रथमः\nविमर्शः\n"
+    assert file_helper.detect_encoding(tmp_path / "legacy.md") == "utf-8"
+
+
+def test_normalize_tree_lone_cr(tmp_path):
+    # Old Mac style line ends must not join lines.
+    old_mac = "line1\rline2\r\nअ line3\r\r\n".encode("utf-16")
+    (tmp_path / "old_mac.txt").write_bytes(old_mac)
+    reports = file_helper.normalize_tree(tmp_path, pattern="*.txt", workers=1)
+    assert reports[0]["encoding"] == "UTF-16"
+    assert (tmp_path / "old_mac.txt").read_bytes() == "line1\nline2\nअ line3\n\n".encode("utf-8")
+    assert (tmp_path / "old_mac.txt").read_bytes() == _clear_bad_chars_in_text_mode(old_mac, encoding="utf-16")
+
+
+def test_normalize_tree_manifest(tmp_path):
+    (tmp_path / "a.md").write_bytes("प्रथमः\r\n".encode("utf-8"))
+    (tmp_path / "b.md").write_text("विमर्शः\n", encoding="utf-8")
+    reports = file_helper.normalize_tree(tmp_path, pattern="*.md", workers=1)
+    assert [report["skipped"] for report in reports] == [False, False]
+    assert (tmp_path / file_helper.NORMALIZATION_MANIFEST_NAME).exists()
+    reports = file_helper.normalize_tree(tmp_path, pattern="*", workers=1)
+    assert [report["skipped"] for report in reports] == [True, True]
+    (tmp_path / "b.md").write_bytes("विमर्शः\r\n".encode("utf-8"))
+    reports = file_helper.normalize_tree(tmp_path, pattern="*.md", workers=1)
+    assert [(report["skipped"], report["changed"]) for report in reports] == [(True, False), (False, True)]
+
+
+def test_clear_bad_chars_in_file_dry_run(tmp_path):
+    file_path = tmp_path / "a.md"
+    file_path.write_bytes("प्रथमः\r\n".encode("utf-8"))
+    file_helper.clear_bad_chars_in_file(file_path, dry_run=True)
+    assert file_path.read_bytes() == "प्रथमः\r\n".encode("utf-8")
+    file_helper.clear_bad_chars_in_file(file_path)
+    assert file_path.read_bytes() == "प्रथमः\n".encode("utf-8")
+
+
+def test_clear_bad_chars_in_file_lone_cr(tmp_path):
+    file_path = tmp_path / "old_mac.txt"
+    file_path.write_bytes(b"line1\rline2\r\nline3\n")
+    file_helper.clear_bad_chars_in_file(file_path)
+    assert file_path.read_bytes() == b"line1\nline2\nline3\n"
+
+
+def test_clear_bad_chars_in_stream():
+    text = "प्रथमः\r\nविमर्शः\u200b ।।\ufeff\u00a0\r\nold\rmac\r\r\n" * 100
+    for encoding in ["utf-8", "utf-16"]:
+        # Odd chunk sizes split multibyte sequences and \r\n pairs across chunks.
+        for chunk_size in [1, 2, 3, 5, 7, 11, 4096]:
+            out_file = io.BytesIO()
+            file_helper.clear_bad_chars_in_stream(in_file=io.BytesIO(text.encode(encoding)), out_file=out_file, encoding=encoding, chunk_size=chunk_size)
+            assert out_file.getvalue() == _clear_bad_chars_in_text_mode(text.encode(encoding), encoding=encoding)
+
+
+def test_normalize_file_streaming(tmp_path):
+    file_path = tmp_path / "a.md"
+    file_path.write_bytes("प्रथमः\r\n".encode("utf-16"))
+    report = file_helper.normalize_file(file_path, streaming=True)
+    assert report["changed"] and report["error"] is None
+    assert file_path.read_bytes() == "प्रथमः\n".encode("utf-8")
+    assert os.listdir(tmp_path) == ["a.md"]
+    assert not file_helper.normalize_file(file_path, streaming=True)["changed"]
+
+
+def test_get_storage_paths():
+    from indic_transliteration import sanscript
+    paths = ["raw/प्रथमविमर्शः/चिद्गगनचन्द्रिका.md", "raw/प्रथमविमर्शः/समलंकृता.md", "raw/प्रथमविमर्शः"]
+    storage_paths = file_helper.get_storage_paths(paths, source_script=sanscript.DEVANAGARI)
+    assert storage_paths == [file_helper.get_storage_path(path, source_script=sanscript.DEVANAGARI) for path in paths]
+    assert storage_paths[0] == "raw/prathamavimarshaH/chidgaganachandrikA.md"
+
+
+def test_rename_files_with_storage_name(tmp_path):
+    from indic_transliteration import sanscript
+    from curation_utils.file_helper.rename_plan import RenamePlan
+    (tmp_path / "प्रथमविमर्शः").mkdir()
+    (tmp_path / "प्रथमविमर्शः" / "समलंकृता.md").write_text("a")
+    (tmp_path / "प्रथमविमर्शः" / "samalaMkRtA.md").write_text("b")
+    (tmp_path / "प्रथमविमर्शः" / "already_fine.md").write_text("c")
+    plan_path = tmp_path.parent / (tmp_path.name + "_plan.json")
+    plan = file_helper.rename_files_with_storage_name(tmp_path, source_script=sanscript.DEVANAGARI, plan_path=plan_path, workers=2)
+    assert len(plan) == 2
+    assert sorted(os.listdir(tmp_path)) == ["prathamavimarshaH"]
+    assert sorted(os.listdir(tmp_path / "prathamavimarshaH")) == ["already_fine.md", "samalaMkRtA.md", "samalaMkRtA__2.md"]
+    assert (tmp_path / "prathamavimarshaH" / "samalaMkRtA__2.md").read_text() == "a"
+    RenamePlan.load(plan_path).undo()
+    assert sorted(os.listdir(tmp_path / "प्रथमविमर्शः")) == sorted(["समलंकृता.md", "samalaMkRtA.md", "already_fine.md"])
+
+
+CLEAN_FILE_PATH_GOLDEN = {
+    "prathamavimarshaH": "prathamavimarshaH",
+    " shrI rAma rakShA stotram ": "shrI_rAma_rakShA_stotram",
+    "01_Adi_parva/02 sambhava.a parva.md": "01_Adi_parva/02_sambhava-_parva.md",
+    "raw_etexts/AgamAH/bauddham/asian_classics_hk": "raw_etexts/AgamAH/bauddham/asian_classics_hk",
+    "Some English title (2nd ed.)": "Some_English_title_2nd_ed.",
+    "vAlmIki-rAmAyaNam_bAla-kANDaH": "vAlmIki-rAmAyaNam_bAla-kANDaH",
+    "so.ayam ātmā": "so-yam_tm",
+    "kaTha upaniShat _ .a": "kaTha_upaniShat_.a",
+    "a _ b__c   d_/e _.md": "a__b__c_d/e_.md",
+    "चिद्गगनचन्द्रिका prathama vimarshaH": "_prathama_vimarshaH",
+    "~/sangItam/kRti 12 - endarO mahAnubhAvulu.mp3": "~/sangItam/kRti_12_-_endarO_mahAnubhAvulu.mp3",
+}
+
+
+def test_clean_file_path():
+    for (title, expected) in CLEAN_FILE_PATH_GOLDEN.items():
+        assert file_helper.clean_file_path(title) == expected
+
+
+def test_clean_file_names(tmp_path):
+    (tmp_path / "My Dir" / "Sub Dir").mkdir(parents=True)
+    (tmp_path / "My Dir" / "a b.txt").write_text("a")
+    (tmp_path / "My Dir" / "a_b.txt").write_text("b")
+    (tmp_path / "My Dir" / "Sub Dir" / "c  d.txt").write_text("c")
+    counts = file_helper.clean_file_names(tmp_path)
+    assert counts == {"checked": 5, "renamed": 3, "skipped": 1, "failed": 0}
+    assert sorted(os.listdir(tmp_path / "My_Dir")) == ["Sub_Dir", "a b.txt", "a_b.txt"]
+    assert os.listdir(tmp_path / "My_Dir" / "Sub_Dir") == ["c_d.txt"]
+
+
+def test_copy_file_tree(tmp_path):
+    # The source dir name recurs deeper in the tree, which str.replace based destination paths got wrong.
+    source_dir = tmp_path / "src"
+    (source_dir / "a" / "src").mkdir(parents=True)
+    (source_dir / "a" / "src" / "x.md").write_text("x")
+    (source_dir / "y.md").write_text("y")
+    dest_dir = tmp_path / "dest"
+    report = file_helper.copy_file_tree(str(source_dir), str(dest_dir), "**/*.md")
+    assert (report["copied"], report["skipped"], report["bytes_copied"]) == (2, 0, 2)
+    assert (dest_dir / "a" / "src" / "x.md").read_text() == "x"
+    report = file_helper.copy_file_tree(str(source_dir), str(dest_dir), "**/*.md")
+    assert (report["copied"], report["skipped"], report["bytes_skipped"]) == (0, 2, 2)
+    (source_dir / "y.md").write_text("yy")
+    report = file_helper.copy_file_tree(str(source_dir), str(dest_dir), "**/*.md", compare_content=True)
+    assert (report["copied"], report["skipped"]) == (1, 1)
+    assert (dest_dir / "y.md").read_text() == "yy"
+
+
+def test_copy_file_zero_from_kernel(tmp_path, monkeypatch):
+    # As copy_file_range does on some kernels and filesystems, for non-empty files.
+    monkeypatch.setattr(os, "copy_file_range", lambda *args: 0, raising=False)
+    monkeypatch.setattr(os, "sendfile", lambda *args: 0, raising=False)
+    content = os.urandom(3 * file_helper.COPY_BUFFER_SIZE + 7)
+    (tmp_path / "a.bin").write_bytes(content)
+    assert file_helper.copy_file(str(tmp_path / "a.bin"), str(tmp_path / "b.bin")) == len(content)
+    assert (tmp_path / "b.bin").read_bytes() == content
+    (tmp_path / "empty.bin").write_bytes(b"")
+    assert file_helper.copy_file(str(tmp_path / "empty.bin"), str(tmp_path / "c.bin")) == 0
+
+
+def test_copy_file_short(tmp_path, monkeypatch):
+    (tmp_path / "a.bin").write_bytes(b"abc")
+    os.utime(str(tmp_path / "a.bin"), (1000000000, 1000000000))
+    source_stat = os.stat(str(tmp_path / "a.bin"))
+    # The source shrinking after it was stat-ed.
+    monkeypatch.setattr(file_helper, "copy_fd_range", lambda in_fd, out_fd, count, **kwargs: count - 1)
+    with pytest.raises(OSError):
+        file_helper.copy_file(str(tmp_path / "a.bin"), str(tmp_path / "b.bin"), source_stat=source_stat)
+    assert os.stat(str(tmp_path / "b.bin")).st_mtime_ns != source_stat.st_mtime_ns
+
+
+def test_concatenate_files(tmp_path, monkeypatch):
+    input_paths = []
+    for i in range(3):
+        input_paths.append(tmp_path / f"{i}.md")
+        input_paths[-1].write_text("अ" * i)
+    file_helper.concatenate_files(input_paths, tmp_path / "out" / "all.md", add_newline_inbetween=True)
+    assert (tmp_path / "out" / "all.md").read_text() == "\nअ\nअअ\n"
+    errors = file_helper.concatenate_files_batch({str(tmp_path / "a.md"): input_paths[1:], str(tmp_path / "b.md"): input_paths[:1] + [tmp_path / "missing.md"]})
+    assert (tmp_path / "a.md").read_text() == "अअअ"
+    assert errors[str(tmp_path / "a.md")] is None and errors[str(tmp_path / "b.md")] is not None
+
+    # A short copy (of an input shrinking while being read, say) is a failure, not a truncated output.
+    monkeypatch.setattr(file_helper, "copy_fd_range", lambda in_fd, out_fd, count, **kwargs: count - 1 if count > 0 else 0)
+    errors = file_helper.concatenate_files_batch({str(tmp_path / "c.md"): input_paths})
+    assert "OSError" in errors[str(tmp_path / "c.md")]
+
+
+def test_download_file(tmp_path, file_server):
+    content = os.urandom(300000)
+    file_server.files["/scan.pdf"] = content
+    url = file_server.base_url + "/scan.pdf"
+    dest = str(tmp_path / "scan.pdf")
+    # Resume from a partial download.
+    with open(dest + ".part", "wb") as part_file:
+        part_file.write(content[:100000])
+    md5 = hashlib.md5(content).hexdigest()
+    assert file_helper.download_file(url, dest, md5=md5) == dest
+    assert file_server.requests[-1] == ("/scan.pdf", "bytes=100000-")
+    assert open(dest, "rb").read() == content
+    assert not os.path.exists(dest + ".part")
+
+    # Servers ignoring ranges restart the download.
+    file_server.support_ranges = False
+    with open(dest + ".part", "wb") as part_file:
+        part_file.write(content[:100])
+    file_helper.download_file(url, dest)
+    assert open(dest, "rb").read() == content
+
+    with pytest.raises(ValueError):
+        file_helper.download_file(url, str(tmp_path / "bad.pdf"), md5="0" * 32)
+    assert not os.path.exists(str(tmp_path / "bad.pdf")) and not os.path.exists(str(tmp_path / "bad.pdf.part"))
+
+
+@pytest.mark.parametrize("content_range_on_416", [True, False])
+def test_download_file_stale_part(tmp_path, file_server, content_range_on_416):
+    file_server.content_range_on_416 = content_range_on_416
+    content = b"hello world"
+    file_server.files["/a.txt"] = content
+    url = file_server.base_url + "/a.txt"
+    dest = str(tmp_path / "a.txt")
+    # A .part file longer than the remote file is stale: it is discarded, not published.
+    with open(dest + ".part", "wb") as part_file:
+        part_file.write(b"x" * 51)
+    file_helper.download_file(url, dest)
+    assert open(dest, "rb").read() == content
+    assert file_server.requests[-1] == ("/a.txt", None)
+    # A .part file exactly as long as the remote file is complete.
+    os.rename(dest, dest + ".part")
+    request_count = len(file_server.requests)
+    file_helper.download_file(url, dest)
+    assert open(dest, "rb").read() == content
+    assert len(file_server.requests) == request_count + 1
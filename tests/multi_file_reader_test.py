@@ -0,0 +1,107 @@
+import io
+import random
+
+from curation_utils.file_helper.multi_file_reader import MultiFileReader
+
+
+def _write_files(tmp_path, contents):
+    paths = []
+    for (i, content) in enumerate(contents):
+        paths.append(str(tmp_path / ("%03d.txt" % i)))
+        with open(paths[-1], "wb") as f:
+            f.write(content)
+    return paths
+
+
+def test_read(tmp_path):
+    contents = [b"abc\n", b"", b"de", b"fgh\nij\n", b""]
+    paths = _write_files(tmp_path, contents)
+    data = b"".join(contents)
+    with MultiFileReader(paths) as reader:
+        assert reader.size == len(data)
+        assert reader.read() == data
+        assert reader.read(3) == b""
+        rng = random.Random(0)
+        for _ in range(200):
+            (offset, n) = (rng.randrange(0, len(data) + 2), rng.randrange(0, 6))
+            reader.seek(offset)
+            assert reader.read(n) == data[offset:offset + n]
+            assert reader.tell() == min(offset + n, max(offset, len(data)))
+        reader.seek(1)
+        buffer = bytearray(6)
+        assert reader.readinto(buffer) == 6 and buffer == data[1:7]
+        reader.seek(2)
+        assert reader.read1() == b"c\n"
+        assert reader.peek(1)[:1] == b"d"
+        assert reader.read(1) == b"d"
+    assert reader.closed
+
+
+def test_text_wrapper(tmp_path):
+    contents = ["प्रथमः\n".encode("utf-8"), "विमर्शः\nअ".encode("utf-8"), "आ\n".encode("utf-8")]
+    # Split a multibyte character across files.
+    contents = [contents[0][:-3], contents[0][-3:] + contents[1], contents[2]]
+    paths = _write_files(tmp_path, contents)
+    with io.TextIOWrapper(MultiFileReader(paths), encoding="utf-8") as text_file:
+        assert text_file.readlines() == ["प्रथमः\n", "विमर्शः\n", "अआ\n"]
+
+
+def test_lazy(tmp_path):
+    contents = [bytes([65 + i]) * (i + 1) for i in range(20)]
+    paths = _write_files(tmp_path, contents)
+    data = b"".join(contents)
+    with MultiFileReader(paths, lazy=True, max_open_files=3) as reader:
+        assert len(reader._files) == 0
+        assert reader.read() == data
+        assert len(reader._files) == 3
+        reader.seek(0)
+        assert reader.read(4) == data[:4]
+        reader.save_manifest(str(tmp_path / "manifest.json"))
+    with MultiFileReader.from_manifest(str(tmp_path / "manifest.json"), lazy=True, max_open_files=2) as reader:
+        assert reader.size == len(data)
+        reader.seek(100)
+        assert reader.read(50) == data[100:150]
+
+
+def test_mmap(tmp_path):
+    contents = [b"abc\n", b"", b"de", b"fgh\nij\n"] * 5
+    paths = _write_files(tmp_path, contents)
+    data = b"".join(contents)
+    with MultiFileReader(paths, use_mmap=True, max_mappings=2) as reader:
+        assert reader.read() == data
+        rng = random.Random(0)
+        for _ in range(200):
+            (offset, n) = (rng.randrange(0, len(data) + 2), rng.randrange(0, 9))
+            assert reader.getbuffer(offset, n) == data[offset:offset + n]
+            reader.seek(offset)
+            assert reader.read(n) == data[offset:offset + n]
+        view = reader.getbuffer(6, 3)
+        assert view.obj is not None and view.readonly
+        assert bytes(view) == b"fgh"
+        # Evicting the map behind a live slice must leave the slice valid.
+        reader.getbuffer(0, len(data))
+        reader.getbuffer(len(data) - 1, 1)
+        assert bytes(view) == b"fgh"
+
+
+def _count_a(record):
+    return record.count(b"a") or None
+
+
+def test_map_records(tmp_path):
+    from curation_utils.file_helper.multi_file_reader import map_records
+    contents = [b"a\nbb\naaa\n", b"", b"no newline at end a", b"\n\nba\n"] * 3
+    paths = _write_files(tmp_path, contents)
+    with MultiFileReader(paths) as reader:
+        ranges = reader.split_ranges(range_size=3)
+        assert [(start, end) for (_, _, start, end) in ranges][:4] == [(0, 5), (5, 9), (9, 28), (28, 33)]
+        results = list(map_records(reader, _count_a, range_size=3, workers=2))
+        expected = []
+        for (path, content, start) in zip(paths, contents, reader._starts):
+            offset = start
+            for record in content.split(b"\n")[:-1] if content.endswith(b"\n") else content.split(b"\n"):
+                if record.count(b"a"):
+                    expected.append((path, offset, record.count(b"a")))
+                offset += len(record) + 1
+        assert results == expected
+        assert sorted(map_records(reader, _count_a, range_size=5, workers=2, ordered=False)) == sorted(expected)
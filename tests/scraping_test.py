@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from curation_utils import scraping
+from curation_utils.scraping.response_cache import ResponseCache, normalize_url
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.client_ports.add(self.client_address[1])
+        self.server.request_log.append((time.monotonic(), self.path))
+        if self.path == "/flaky" and [path for (_, path) in self.server.request_log].count("/flaky") == 1:
+            # Rate limited, the first time.
+            self.server.statuses.append(429)
+            self.send_response(429)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        etag = '"%s"' % self.path
+        if self.headers.get("If-None-Match") == etag:
+            self.server.statuses.append(304)
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path == "/missing":
+            body = b"Not here"
+            self.send_response(404)
+        else:
+            body = ("<html><head><title>%s</title></head><body><a href='/next'>next</a></body></html>" % self.path.strip("/")).encode("utf-8")
+            self.send_response(200)
+            self.send_header("ETag", etag)
+        self.server.statuses.append(200 if self.path != "/missing" else 404)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.client_ports = set()
+    server.statuses = []
+    # (monotonic time, path) of each request, as received.
+    server.request_log = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def server():
+    server = _start_server()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _base_url(server):
+    return "http://127.0.0.1:%d" % server.server_address[1]
+
+
+def test_scraper_reuses_connections(server):
+    with scraping.Scraper() as scraper:
+        for i in range(10):
+            (soup, result) = scraping.get_soup("%s/page%d" % (_base_url(server), i), scraper=scraper)
+            assert result.status_code == 200
+            assert soup.title.text == "page%d" % i
+        soup = scraping.get_post_soup("%s/posted" % _base_url(server), scraper=scraper)
+        assert soup.title.text == "posted"
+    # All requests went over one kept-alive connection.
+    assert len(server.client_ports) == 1
+
+
+def test_scraper_404(server):
+    with scraping.Scraper() as scraper:
+        (soup, result) = scraping.get_soup("%s/missing" % _base_url(server), scraper=scraper)
+    assert soup is None
+    assert result.status_code == 404
+
+
+def _fetch_all(urls, **kwargs):
+    async def fetch_all():
+        return [item async for item in scraping.fetch_many(urls, **kwargs)]
+    return asyncio.run(fetch_all())
+
+
+def test_fetch_many(server):
+    other_server = _start_server()
+    try:
+        urls = ["%s/page%d" % (_base_url(s), i) for s in [server, other_server] for i in range(4)]
+        urls.append("%s/missing" % _base_url(server))
+        urls.append("%s/flaky" % _base_url(server))
+        results = _fetch_all(urls, per_host_concurrency=1, min_delay=0.2)
+    finally:
+        other_server.shutdown()
+        other_server.server_close()
+    assert sorted(url for (url, _) in results) == sorted(urls)
+    for (url, result) in results:
+        assert result.status_code == (404 if url.endswith("missing") else 200)
+    assert [path for (_, path) in server.request_log].count("/flaky") == 2
+    # Requests to a host, including retries, start min_delay apart (less some slack for when they are received).
+    for s in [server, other_server]:
+        request_times = [request_time for (request_time, _) in s.request_log]
+        assert min(later - earlier for (earlier, later) in zip(request_times, request_times[1:])) >= 0.15
+    # The hosts are fetched from in parallel.
+    assert other_server.request_log[0][0] < server.request_log[1][0]
+
+
+def test_normalize_url():
+    assert normalize_url("HTTP://Example.com:80/a?b=2&a=1#top") == "http://example.com/a?a=1&b=2"
+    assert normalize_url("https://example.com:8443") == "https://example.com:8443/"
+
+
+def test_response_cache(server, tmp_path):
+    cache_path = str(tmp_path / "cache.sqlite")
+    urls = ["%s/page%d" % (_base_url(server), i) for i in range(3)] + ["%s/missing" % _base_url(server)]
+    with ResponseCache(cache_path) as cache:
+        with scraping.Scraper(cache=cache) as scraper:
+            for url in urls:
+                scraper.get(url)
+            assert server.statuses == [200, 200, 200, 404]
+            # Revalidation: unchanged pages are not downloaded again.
+            (soup, result) = scraping.get_soup(urls[0] + "#frag", scraper=scraper)
+            assert soup.title.text == "page0"
+            assert result.extensions["from_cache"]
+            assert server.statuses[-1] == 304
+        assert len(cache) == 4
+
+    # Across restarts, and offline.
+    with ResponseCache(cache_path, offline=True) as cache:
+        statuses_count = len(server.statuses)
+        (soup, _) = scraping.get_soup(urls[1], cache=cache)
+        assert soup.title.text == "page1"
+        (soup, result) = scraping.get_soup("%s/new" % _base_url(server), cache=cache)
+        assert soup is None
+        assert result.status_code == 504
+        assert len(server.statuses) == statuses_count
+
+    # Size-bounded eviction keeps the most recently used.
+    with ResponseCache(cache_path) as cache:
+        cache.max_size = len(zlib.compress(cache.get(urls[2])["body"]))
+        cache.put(urls[2], cache.to_response(cache.get(urls[2])))
+        assert len(cache) == 1
+        assert cache.get(urls[2]) is not None
+        # The running total of sizes matches the table.
+        assert cache._total_size == cache._connection.execute("SELECT SUM(size) FROM responses").fetchone()[0] == cache.max_size
+
+
+def test_get_soup_list_config_aws(monkeypatch):
+    monkeypatch.setattr(scraping, "get_url_aws", lambda url, config_aws: scraping.httpx.Response(200, text="<title>%s</title>" % config_aws[0]))
+    (soup, _) = scraping.get_soup("https://example.com/", config_aws=["key", "secret"])
+    assert soup.title.text == "key"
+
+
+SAMPLE_PAGE = """<html><head><title>t</title></head><body>
+<div id="nav"><a href="/home">Home</a></div>
+<div class="entry main"><h1>Heading</h1><p>Text <a href="next.html">next</a></p></div>
+<p class="main">Aside</p>
+</body></html>"""
+
+
+@pytest.mark.parametrize("features", ["html.parser", None])
+def test_make_soup_parse_only(features):
+    assert [div["id"] for div in scraping.make_soup(SAMPLE_PAGE, features=features, parse_only="#nav").find_all("div")] == ["nav"]
+    soup = scraping.make_soup(SAMPLE_PAGE, features=features, parse_only="div.main")
+    assert soup.find("title") is None
+    assert soup.h1.text == "Heading"
+    assert [tag.name for tag in scraping.make_soup(SAMPLE_PAGE, features=features, parse_only=".main").find_all(class_="main")] == ["div", "p"]
+    assert [tag.name for tag in scraping.make_soup(SAMPLE_PAGE, features=features, parse_only="h1, title").find_all(True)] == ["title", "h1"]
+    with pytest.raises(ValueError):
+        scraping.get_soup_strainer("div > p")
+
+
+def test_extract_text_and_links():
+    (text, links) = scraping.extract_text_and_links(SAMPLE_PAGE, base_url="https://example.com/a/")
+    assert "Heading" in text and "Aside" in text
+    assert links == ["https://example.com/home", "https://example.com/a/next.html"]